@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# (can be run in either Python 2 or Python 3)
+
+"""MIDI beeper benchmark (c) Silas S. Brown.  License: Apache 2
+
+Generates synthetic MIDI files (the same ones every time)
+and times midi-beeper.py converting them to each output,
+with fake aplay, beep and sudo commands so nothing is
+played or installed.  Records time, peak memory and the
+time in each stage (from --profile-json), and can compare
+with an earlier run to catch slow-downs.  Also checks that
+importing midi-beeper.py as a module (which shouldn't do
+anything until setup() is called) takes under import_budget.
+
+Syntax: python midi-beeper-bench.py [options]
+Options: --json FILE (save results)
+         --compare OLD.json [NEW.json] (against this run, or another saved one)
+         --script PATH (another midi-beeper.py, e.g. an older version)
+         --scale X (multiply the number of notes, default 1)
+         --repeat N (take the fastest of N runs, default 3)
+         --only backend,backend... --tolerance 0.1"""
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os,sys,time,json,random,shutil,subprocess,tempfile
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from ringtone import MidiOutFile
+
+corpus = [ # name, MIDI format, tracks, notes per track, max notes per chord, ticks per note (96 = crotchet)
+  ("solo", 0, 1, 400, 1, 48),
+  ("quartet", 1, 4, 1000, 2, 48),
+  ("dense", 1, 8, 1500, 3, 12),
+  ("long", 1, 2, 10000, 1, 24),
+  ]
+
+backends = [ # name, midi-beeper.py options, environment
+  ("bbc", ["--bbc"], {}),
+  ("bbc-binary", ["--bbc-binary"], {}),
+  ("bbc-ssd", ["--bbc-ssd"], {}),
+  ("maestro", ["--maestro"], {}),
+  ("qbasic", ["--qbasic"], {}),
+  ("grub", ["--grub"], {"GRUB_TUNE":"tune"}),
+  ("aplay", [], {"APLAY_VOL":"100"}),
+  ("beep", [], {}),
+  ]
+
+import_budget = 0.05 # seconds
+
+# Run by a separate interpreter: imports the script, and
+# prints how long that took (not counting Python's startup)
+importTimer = """import sys,time
+t = time.time()
+try:
+  import importlib.util
+  spec = importlib.util.spec_from_file_location("midi_beeper",sys.argv[1])
+  spec.loader.exec_module(importlib.util.module_from_spec(spec))
+except ImportError: # Python 2
+  import imp ; imp.load_source("midi_beeper",sys.argv[1])
+sys.stderr.write("%f\\n" % (time.time()-t))"""
+
+def makeMidi(fname,format,tracks,notes,poly,step,seed):
+  # Returns the number of notes written
+  rng = random.Random(seed) ; trackEvents = [] ; count = 0
+  for t in range(tracks):
+    events = [] ; tick = 0 ; channel = t % 9 # (avoid percussion)
+    for i in range(notes):
+      length = rng.choice([step//2,step,step*2,step*3//2])
+      for p in rng.sample(range(40+3*t,64+3*t),rng.randint(1,poly)):
+        events.append((tick,1,"note_on",(channel,p,0x40)))
+        events.append((tick+length,0,"note_off",(channel,p,0x40))) # (0 = before any note_on at the same time)
+        count += 1
+      if rng.random() < 0.05: events.append((tick+1,2,"pitch_bend",(channel,rng.randint(0x1800,0x2800))))
+      if rng.random() < 0.02: events.append((tick,2,"tempo",(rng.randint(300000,700000),)))
+      tick += length
+    trackEvents.append(events)
+  if format==0: trackEvents = [sum(trackEvents,[])]
+  else: trackEvents.insert(0,[(0,2,"tempo",(500000,))])
+  mof = MidiOutFile(fname)
+  mof.header(format,len(trackEvents),96)
+  for events in trackEvents:
+    mof.start_of_track() ; tick = 0
+    for t,_,method,args in sorted(events):
+      mof.update_time(t-tick) ; tick = t
+      getattr(mof,method)(*args) ; mof.reset_time()
+    mof.end_of_track()
+  mof.write()
+  return count
+
+def run(script,args,cwd,env):
+  # Returns (seconds, peak RSS in kilobytes or None, stderr)
+  err = tempfile.TemporaryFile()
+  t = time.time()
+  p = subprocess.Popen([sys.executable,script]+args,cwd=cwd,env=env,stdin=open(os.devnull),stdout=open(os.devnull,'w'),stderr=err)
+  if hasattr(os,'wait4'):
+    _,status,usage = os.wait4(p.pid,0)
+    p.returncode = status ; rss = usage.ru_maxrss
+    if sys.platform=="darwin": rss //= 1024 # (bytes there)
+  else: status,rss = p.wait(),None
+  t = time.time()-t
+  err.seek(0) ; err = err.read().decode('latin1')
+  if status: raise Exception("%s %s failed:\n%s" % (script," ".join(args),err))
+  return t,rss,err
+
+def fakeCommands(d):
+  for cmd in ["aplay","beep","sudo"]: # (sudo in case --script is older than GRUB_TUNE)
+    f = os.path.join(d,cmd)
+    open(f,"w").write("#!/bin/sh\ncat > /dev/null\n")
+    os.chmod(f,0o755)
+
+def benchmark(script,scale,repeat,only):
+  d = tempfile.mkdtemp() ; results = []
+  try:
+    fakeCommands(d)
+    env = dict((k,v) for k,v in os.environ.items() if not k in ["APLAY_VOL","maxTime","MIDI_BEEPER_CACHE","DFS_TITLE"])
+    env["PATH"] = d+os.pathsep+env.get("PATH","")
+    startup = min(run(script,["--version"],d,env)[0] for _ in range(repeat))
+    imported = min(float(run("-c",[importTimer,script],d,env)[2]) for _ in range(repeat))
+    sys.stderr.write("import %.3fs%s\n" % (imported,("" if imported < import_budget else " (over the %gs budget)" % import_budget)))
+    for seed,(name,format,tracks,notes,poly,step) in enumerate(corpus):
+      midiFile = name+".mid"
+      nNotes = makeMidi(os.path.join(d,midiFile),format,tracks,max(1,int(notes*scale)),poly,step,seed)
+      size = os.path.getsize(os.path.join(d,midiFile))
+      for backend,args,extraEnv in backends:
+        if only and not backend in only: continue
+        e = env.copy() ; e.update(extraEnv)
+        total = rss = None
+        try:
+          for _ in range(repeat):
+            t,r,_ = run(script,args+[midiFile],d,e)
+            if total is None or t < total: total,rss = t,r
+          try: err = run(script,["--profile-json"]+args+[midiFile],d,e)[2] # (separately, as it adds some overhead)
+          except Exception: err = "" # --script is older than --profile-json
+        except Exception:
+          sys.stderr.write("%s on %s: %s\n" % (backend,name,sys.exc_info()[1]))
+          results.append({"corpus":name,"backend":backend,"error":[l for l in str(sys.exc_info()[1]).split("\n") if l.strip()][-1]}) ; continue
+        r = {"corpus":name,"backend":backend,"notes":nNotes,"bytes":size,"seconds":round(total,4),"peak_rss_kb":rss,"notes_per_second":int(nNotes/total)}
+        for l in err.split("\n"):
+          if l.startswith('{"profile"'):
+            p = json.loads(l) ; secs = p["seconds"]
+            r.update({"stages":dict((k,round(v,4)) for k,v in secs.items()),"counts":p["counts"],"output":p["output"],"output_unit":p["output_unit"]})
+            # (dedup includes format 1's merging of the tracks,
+            # and output includes the BBC Micro's second pass)
+            r["parse_seconds"] = round(sum(secs.get(k,0) for k in ["parse","timeline","dedup"]),4)
+            r["output_seconds"] = round(sum(secs.get(k,0) for k in ["output","write"]),4)
+            r["other_seconds"] = round(secs.get("other",0),4)
+        results.append(r)
+        sys.stderr.write("%-8s %-10s %7.3fs %s\n" % (name,backend,total,rss and ("%6dk" % rss) or ""))
+  finally: shutil.rmtree(d)
+  try: import numpy ; numpy = numpy.__version__
+  except ImportError: numpy = None
+  return {"python":sys.version.split()[0],"platform":sys.platform,"numpy":numpy,"scale":scale,"repeat":repeat,"startup_seconds":round(startup,4),"import_seconds":round(imported,4),"results":results}
+
+def compare(old,new,tolerance):
+  # Returns True if nothing got slower (or bigger) beyond the tolerance
+  oldR = dict(((r["corpus"],r["backend"]),r) for r in old["results"])
+  ok = True
+  for k in ["python","numpy","scale"]:
+    if not old.get(k)==new.get(k): print("(Note %s was %s, now %s)" % (k,old.get(k),new.get(k)))
+  if new.get("import_seconds",0) >= import_budget:
+    print("import_seconds %.3f is over the %gs budget" % (new["import_seconds"],import_budget)) ; ok = False
+  for r in new["results"]:
+    o = oldR.get((r["corpus"],r["backend"]))
+    if not o or "error" in o or "error" in r:
+      print("%-8s %-10s %s" % (r["corpus"],r["backend"],r.get("error","(no comparison)"))) ; continue
+    out = []
+    for k in ["seconds","parse_seconds","output_seconds","other_seconds","peak_rss_kb"]:
+      if not o.get(k) or r.get(k) is None: continue
+      ratio = r[k]/float(o[k]) ; flag = ""
+      if ratio > 1+tolerance and (k=="peak_rss_kb" or r[k]-o[k] > 0.01): flag,ok = " WORSE",False # (ignore timer noise on tiny times)
+      out.append("%s %.2fx%s" % (k,ratio,flag))
+    print("%-8s %-10s %s" % (r["corpus"],r["backend"],", ".join(out)))
+  return ok
+
+def main():
+  args = sys.argv[1:]
+  def opt(name,default=None):
+    if not name in args: return default
+    i = args.index(name) ; v = args[i+1] ; del args[i:i+2]
+    return v
+  if "--help" in args:
+    print(__doc__) ; return
+  jsonFile = opt("--json")
+  compareWith = opt("--compare")
+  script = opt("--script",os.path.join(os.path.dirname(os.path.abspath(__file__)),"midi-beeper.py"))
+  scale = float(opt("--scale",1))
+  repeat = int(opt("--repeat",3))
+  only = opt("--only") ; only = only and only.split(",")
+  tolerance = float(opt("--tolerance",0.1))
+  if compareWith and args and args[0].endswith(".json"): new = json.load(open(args.pop(0)))
+  else: new = benchmark(os.path.abspath(script),scale,repeat,only)
+  if args: sys.stderr.write("Unrecognised: %s\n" % " ".join(args)) ; sys.exit(1)
+  if jsonFile: json.dump(new,open(jsonFile,"w"),indent=1,sort_keys=True)
+  elif not compareWith: print(json.dumps(new,indent=1,sort_keys=True))
+  if compareWith and not compare(json.load(open(compareWith)),new,tolerance): sys.exit(1)
+
+if __name__=="__main__": main()
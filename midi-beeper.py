@@ -11,30 +11,47 @@ License: Apache 2""" # (see below)
 # is attached.  It should work on any machine that has the
 # "beep" Linux package, like old NSLU2 network storage devices.
 # (On NSLU2 do 'sudo modprobe isp4xx_beeper' before running)
+beep_direct = 0 # or run with --direct to drive the beeper from Python (console ioctl, or the NSLU2's input device) instead of running "beep", which avoids gaps between beep commands; needs write access to the device.  Set BEEP_DEVICE environment variable to choose the device (a regular file there gets the input events written to it, for testing)
 
 # Can also install a MIDI file into the GNU GRUB bootloader
 # (sudo access required; does not work on all machines
 # e.g. some laptops have no beeper)
 grub = 0 # or run with --grub
+grub_tune_file = "" # or set GRUB_TUNE environment variable to a filename to just write the tune there instead of installing it
 
 # Can also play MIDI files using square-wave synthesis with aplay
 # (e.g. on Raspberry Pi) - set aplay below if you want this instead.
 # Set it to a volume level, e.g. aplay = 100
 aplay = 0 # or set APLAY_VOL environment variable
+aplay_rate = 8000 # or run with --rate N (higher rates are fine on a Raspberry Pi if numpy is installed)
+aplay_osc = "square" # or run with --osc wavetable for band-limited square waves (less aliasing on high notes; needs numpy)
+aplay_buffer = 0 # or run with --buffer N to parse, render and write to aplay in separate threads with up to N rendered chords queued for aplay (underruns are reported so you can tune N).  Sound starts while a format 0 MIDI file is still being parsed, but a format 1 file's tracks are one after another in the file, so they have to be parsed to the end before they can be merged: playback then starts as soon as the merge (which goes along with it) has its first chord
+
+drift_compensation = 1 # beep and aplay carry each chord's rounding into the next so long pieces finish on time (0 = old timing)
+show_drift = 0 # or run with --drift to report timing statistics for beep and aplay
 
 # Can also convert MIDI files to RISC OS Maestro music files
 # for playing (but not typesetting well) on 'vanilla' RISC OS.
+# Barlines go where the MIDI file's time signatures put them
+# (4/4 if it has none), so notes aren't tied across them.
 # Set riscos_Maestro = 1 below if you want this.
 # (Defaults to 1 when script is run on RISC OS, unless one
 # of the BBC Micro options is specified instead.)
 riscos_Maestro = 0 # or run with --maestro
+maestro_bpm = 0 # or run with --maestro-bpm N to play at N beats per minute (one of the tempos Maestro allows), or --maestro-bpm auto to try each tempo and keep the smallest file (0 = the fastest, which is the most accurate)
+maestro_bpm_tolerance = 10 # or run with --maestro-tolerance MS: how far --maestro-bpm auto may move the start and end of notes on average, in milliseconds
 
 # Can also convert MIDI files to BBC Micro programs
 # (printed to standard output).  Set bbc_micro below:
 bbc_micro = 0 # or run with --bbc
 acorn_electron = 0 # or run with --electron: Acorn Electron version (more limited)
 bbc_binary = 0 # or run with --bbc-binary: make the above use direct memory access instead of DATA (packs more in but harder to save/edit)
-bbc_ssd = 0 # or run with --bbc-ssd: writes an SSD image (for an emulator) instead of printing keystrokes to standard output (set environment DFS_TITLE to title the disk; disk will contain one BBC program for each MIDI file on the command line + bootloader)
+bbc_ssd = 0 # or run with --bbc-ssd: writes an SSD image (for an emulator) instead of printing keystrokes to standard output (set environment DFS_TITLE to title the disk; disk will contain one BBC program for each MIDI file on the command line + bootloader; if they don't fit, they're split among as few disks as possible, each with its own bootloader)
+bbc_dsd = 0 # or run with --bbc-dsd: as --bbc-ssd but writes double-sided DSD images (the bootloader on side 0 goes on to side 2)
+bbc_allocate = 1 # or run with --bbc-fixed-channels for 0 or --bbc-move-arpeggios for 2: 1 lets the BBC Micro (not Electron) program play each chord's groups of notes on whichever of its channels makes less DATA (sounds the same); 2 also lets it arpeggiate the extra notes in any channel (not always the bass) if that makes less
+bbc_noise_bass = "off" # or run with --bbc-noise-bass on|auto: on the BBC Micro (not Electron or BBC SDL), play each chord's lowest note on the noise channel if it's below the tone channels' range (periodic noise tuned by a silent channel 1, so the other notes get channels 2 and 3); auto does this if a first pass over the piece finds such notes in at least a quarter of its chords and no chord with more than 6 other notes.  Usually makes more DATA (the other notes change channel more often), and a solo line that goes low moves onto the noise channel, so it's not the default; not yet tried on real hardware
+bbc_paste_limit = 32768 # keystrokes an emulator will take in one paste (BeebEm); --bbc-binary uses a denser but slower-to-paste input loop if it gets under this when EQU doesn't
+bbc_paste_rate = 20 # keystrokes per second, assumed when estimating how long --bbc-binary output takes to paste
 bbc_sdl = 0 # or run with --bbc-sdl: makes the BBC Micro code compatible with R.T.Russell's BBC BASIC for SDL.  Code still runs on the real BBC too, but is larger.
 
 # HiBasic (Tube) support (~30k for programs) fully works
@@ -69,7 +86,17 @@ Anytime_Player_bug_workaround = 1
 
 force_monophonic = 0  # set this to 1 to have only the top line (not normally necessary)
 
+chord_cache = "" # or set MIDI_BEEPER_CACHE environment variable to a directory: parsed chords are kept there (keyed by the file's contents and the options that affect them) so converting the same MIDI again, e.g. to another format, can skip parsing
+chord_cache_size = 50 # megabytes (or set MIDI_BEEPER_CACHE_MB); least recently used entries are removed beyond this
+
+profile = 0 # or run with --profile to see where each file's conversion time went (or --profile-json for one line of JSON per file, on standard error)
+
+jobs = 1 # or run with --jobs N to convert N files at a time (for --maestro, --qbasic, --bbc-ssd and the Mac voices, which write one output per file)
+
+serve = "" # or run with --serve PORT to be a conversion service on localhost, or --serve PATH to listen on a Unix domain socket instead: POST a MIDI file to /convert?--maestro (options separated by &, which can also set DFS_TITLE= or maxTime=; only the options in serve_options below are allowed) and the output comes back; GET /metrics for queue depth and latency.  Converts --jobs files at a time (default one per CPU), each in a fresh process forked from a worker.  Other options given with --serve become defaults.  Only the outputs that make a file (or standard output) can be served, not beep, aplay, the Mac voices or --json.
+
 maxTime = 0 # set to number of seconds (or set maxTime environment variable) to limit length of playback, 0 = unlimited
+start_time = 0 # or run with --start SECONDS (or MINUTES:SECONDS) to start playing partway through (maxTime then counts from there).  With MIDI_BEEPER_CACHE set, files that are in the cache seek straight there via an index instead of being parsed again
 
 # Licensed under the Apache License, Version 2.0 (the "License");
 # you may not use this file except in compliance with the License.
@@ -94,60 +121,296 @@ maxTime = 0 # set to number of seconds (or set maxTime environment variable) to
 
 import os,sys
 from struct import pack, unpack
+from array import array
+from bisect import bisect_right
 if sys.version_info < (2,2): sys.stderr.write("Warning: Not tested on Python 2.1 and earlier\nYou might need to introduce long() in various places\nto avoid overflow after 35 minutes\n\n") # due to microseconds count (if you really want to listen to beeped MIDI that long)
 def delArg(a):
   found = a in sys.argv
   if found: sys.argv.remove(a)
   return found
-if delArg('--maestro'): riscos_Maestro = 1
-if delArg('--bbc'): bbc_micro = 1
-if delArg('--electron'): acorn_electron = 1
-if delArg('--bbc-binary'): bbc_binary=bbc_micro=1
-if delArg('--bbc-ssd'): bbc_ssd=bbc_micro=1
-if delArg('--bbc-sdl'): bbc_sdl=bbc_micro=1
-if delArg('--grub'): grub=1
-if delArg('--qbasic'): qbasic=1
-if delArg('--Organ'): mac_voice="Organ"
-if delArg('--Joelle'): mac_voice="Joelle"
-if delArg('--praat'): mac_voice_praat_correction=1
-if delArg('--json'): voice_json=1
-assert not (bbc_sdl and (bbc_binary or bbc_ssd)), "bbc_sdl not compatible with bbc_binary or bbc_ssd"
-
-on_riscos = sys.platform.lower().find("riscos")>=0
-if on_riscos and not (bbc_micro or acorn_electron): riscos_Maestro = 1
-elif not aplay: aplay=int(os.environ.get("APLAY_VOL",0))
-if riscos_Maestro or bbc_micro or acorn_electron or grub or qbasic or mac_voice or voice_json: aplay = 0
-
-# To add a new type of beeper, get the following 'if' block to do any necessary global setup and to define the appropriate version of the per-file init() and of add_midi_note_chord(), then check the 'if' after 'ensure flushed' at end, and quantiseTo logic
-if aplay:
-  rate = 8000 # can just about manage 3 or 4 channels on a Raspberry Pi if it isn't doing anything else
-  o = os.popen("aplay -q -t raw -c 1 -f U8 -r %d" % rate,"w")
+def delArgVal(a,default=None): # --opt VALUE or --opt=VALUE
+  for i in range(1,len(sys.argv)):
+    if sys.argv[i]==a and i+1<len(sys.argv):
+      v = sys.argv[i+1] ; del sys.argv[i:i+2] ; return v
+    elif sys.argv[i].startswith(a+"="):
+      v = sys.argv[i][len(a)+1:] ; del sys.argv[i] ; return v
+  return default
+
+import time
+try: monotonic = time.monotonic
+except AttributeError: monotonic = time.time # Python 2
+class Scheduler:
+  # For the real-time backends (beep and aplay), which can
+  # only play whole milliseconds, samples or arpeggio pulses.
+  # Each chord asks length() for its length plus the error
+  # carried from the ones before (as dedup_microsec_error
+  # does for the quantised backends) and tells took() what
+  # it actually scheduled.  Players can also check they're
+  # keeping up with the monotonic clock via start() & wait().
+  def __init__(self):
+    self.wanted = self.scheduled = self.maxDrift = 0
+    self.chords = 0 ; self.t0 = None ; self.maxLate = 0
+  def length(self,microsecs): # returns milliseconds
+    self.wanted += microsecs / 1000.0
+    if drift_compensation: return max(0,self.wanted - self.scheduled)
+    else: return microsecs / 1000 # (as before, including Python 2's integer division)
+  def took(self,millisecs):
+    self.scheduled += millisecs ; self.chords += 1
+    self.maxDrift = max(self.maxDrift,abs(self.scheduled-self.wanted))
+  def start(self): self.t0,self.played = monotonic(),0
+  def wait(self,millisecs,sleep=True):
+    # call after starting something millisecs long: sleeps
+    # until it should end, or notes how late we are
+    self.played += millisecs
+    d = self.t0 + self.played/1000.0 - monotonic()
+    if d > 0:
+      if sleep: time.sleep(d)
+    else: self.maxLate = max(self.maxLate,-d)
+  def report(self):
+    sys.stderr.write("Scheduled %.3fs for %.3fs of music in %d chords (rounding drift up to %.1fms)\n" % (self.scheduled/1000.0,self.wanted/1000.0,self.chords,self.maxDrift))
+    if not self.t0 is None: sys.stderr.write("Playback was up to %.1fms behind the clock\n" % (self.maxLate*1000))
+
+def readOptions(): # from the command line
+  global riscos_Maestro,bbc_micro,acorn_electron,bbc_binary
+  global bbc_ssd,bbc_dsd,bbc_sdl,bbc_allocate,grub,qbasic
+  global mac_voice,mac_voice_praat_correction,voice_json
+  global beep_direct,show_drift,profile,aplay_rate,aplay_osc
+  global aplay_buffer,jobs,bbc_noise_bass,maestro_bpm
+  global maestro_bpm_tolerance,serve,start_time
+  if delArg('--maestro'): riscos_Maestro = 1
+  if delArg('--bbc'): bbc_micro = 1
+  if delArg('--electron'): acorn_electron = 1
+  if delArg('--bbc-binary'): bbc_binary=bbc_micro=1
+  if delArg('--bbc-ssd'): bbc_ssd=bbc_micro=1
+  if delArg('--bbc-dsd'): bbc_dsd=bbc_ssd=bbc_micro=1
+  if delArg('--bbc-sdl'): bbc_sdl=bbc_micro=1
+  if delArg('--bbc-fixed-channels'): bbc_allocate=0
+  if delArg('--bbc-move-arpeggios'): bbc_allocate=2
+  if delArg('--grub'): grub=1
+  if delArg('--qbasic'): qbasic=1
+  if delArg('--Organ'): mac_voice="Organ"
+  if delArg('--Joelle'): mac_voice="Joelle"
+  if delArg('--praat'): mac_voice_praat_correction=1
+  if delArg('--json'): voice_json=1
+  if delArg('--direct'): beep_direct=1
+  if delArg('--drift'): show_drift=1
+  if delArg('--profile'): profile=1
+  if delArg('--profile-json'): profile="json"
+  aplay_rate = int(delArgVal('--rate',aplay_rate))
+  aplay_osc = delArgVal('--osc',aplay_osc)
+  aplay_buffer = int(delArgVal('--buffer',aplay_buffer))
+  jobs = int(delArgVal('--jobs',jobs))
+  bbc_noise_bass = delArgVal('--bbc-noise-bass',bbc_noise_bass)
+  maestro_bpm = delArgVal('--maestro-bpm',maestro_bpm)
+  maestro_bpm_tolerance = float(delArgVal('--maestro-tolerance',maestro_bpm_tolerance))
+  serve = delArgVal('--serve',serve)
+  start = delArgVal('--start',delArgVal('--seek'))
+  if start: start_time = sum(float(x)*60**i for i,x in enumerate(reversed(start.split(":"))))
+
+def setup():
+  # Sets up the output chosen by the options above.  This
+  # isn't done on import, so the file can be used as a
+  # module: set its options, call setup(), then convert()
+  # each file and finish().  (Importing it should take
+  # well under 50ms as nothing else happens until then;
+  # midi-beeper-bench.py checks this.)  Each output has a
+  # setup function below, which can also be called directly
+  # once the options are set.
+  global chord_cache,chord_cache_size,on_riscos,riscos_Maestro
+  global aplay,scheduler,maxMicrosecs
+  chord_cache = os.environ.get("MIDI_BEEPER_CACHE",chord_cache)
+  chord_cache_size = float(os.environ.get("MIDI_BEEPER_CACHE_MB",chord_cache_size))
+  assert not (bbc_sdl and (bbc_binary or bbc_ssd)), "bbc_sdl not compatible with bbc_binary or bbc_ssd"
+  assert bbc_noise_bass in ["on","off","auto"], "--bbc-noise-bass must be on, off or auto"
+
+  on_riscos = sys.platform.lower().find("riscos")>=0
+  if on_riscos and not (bbc_micro or acorn_electron): riscos_Maestro = 1
+  elif not aplay: aplay=int(os.environ.get("APLAY_VOL",0))
+  if riscos_Maestro or bbc_micro or acorn_electron or grub or qbasic or mac_voice or voice_json: aplay = 0
+
+  scheduler = Scheduler()
+  maxMicrosecs = float(os.environ.get("maxTime",maxTime))*1e6
+  if maxMicrosecs: maxMicrosecs += start_time*1e6
+  del midi_note_to_freq[:]
+  for i in range(128): midi_note_to_freq.append((A/32.0)*math.pow(2,(i-9)/12.0))
+  assert midi_note_to_freq[69] == A # (comment this out if using floating-point tuning because it might fail due to rounding)
+
+  # To add a new type of beeper, write a setup function for it like the ones below, to do any necessary global setup and to define the appropriate version of the per-file init() and of add_midi_note_chord(), call it from the following 'if' block, then check the 'if' after 'ensure flushed' at end, and quantiseTo logic
+  if aplay: setupAplay()
+  elif bbc_micro or acorn_electron: setupBBC()
+  elif riscos_Maestro: setupMaestro()
+  elif mac_voice: setupMacVoice()
+  elif voice_json: setupJson()
+  elif qbasic: setupQbasic()
+  elif grub: setupGrub()
+  else: setupBeep()
+  if profile: setupProfile()
+
+def setupAplay():
+  global rate,o,aplay_pipe,init,wavetable_len,wavetables
+  global wavetable_phases,oscillators,aplay_osc,oscillator
+  global add_midi_note_chord,aplay_finish,chordQ,sampleQ
+  global underruns,threads
+  rate = aplay_rate
+  o = aplay_pipe = os.popen("aplay -q -t raw -c 1 -f U8 -r %d" % rate,"w")
   try:
-    oWrap,o = o,o.buffer # Python 3
+    o = o.buffer # Python 3
     def bchr(n): return bytes((n,))
   except AttributeError: bchr = chr # Python 2
+  try: import numpy
+  except ImportError: numpy = None # use the pure-Python renderer below (same output, just slower)
   def init(): pass
   def chord(freqs,millisecs):
-    samples = millisecs * rate / 1000 ; halfPeriods = []
+    # Renders the whole chord as one block rather than
+    # sample by sample.  Voice i's k'th flip is at sample
+    # int(k*halfPeriods[i]) (multiplying rather than adding
+    # is necessary especially at low rates as periods are
+    # rarely integers), and flips that coincide are applied
+    # in voice order, so the running total is rounded
+    # exactly as it was when we wrote one sample at a time.
+    halfPeriods = []
     for f in freqs: halfPeriods.append(rate/2.0/f)
     assert not 0 in halfPeriods
-    nextFlips = list(map(int,halfPeriods))
-    counts = [1]*len(halfPeriods)
-    val = 0
-    if nextFlips: next=[aplay/len(halfPeriods)]*len(halfPeriods)
-    else: next = []
-    t = 0
-    while t < samples:
-        while t in nextFlips:
-            i = nextFlips.index(t)
-            val += next[i]
-            next[i] = -next[i]
-            counts[i] += 1
-            nextFlips[i] = int(counts[i]*halfPeriods[i]) # necessary especially at low rates as periods are rarely integers
-        o.write(bchr(int(val))) ; t += 1
+    nSamples = numSamples(millisecs)
+    if not halfPeriods: return bchr(0)*nSamples
+    amp = aplay/len(halfPeriods)
+    if numpy: return chord_numpy(halfPeriods,nSamples,amp)
+    flips = []
+    for i in range(len(halfPeriods)):
+      k,delta = 1,amp
+      t = int(halfPeriods[i])
+      while t < nSamples:
+        flips.append((t,i,k,delta))
+        k += 1 ; delta = -delta
+        t = int(k*halfPeriods[i])
+    flips.sort()
+    out = [] ; val = pos = 0
+    for t,i,k,delta in flips:
+      if t > pos:
+        out.append(bchr(int(val))*(t-pos)) ; pos = t
+      val += delta
+    out.append(bchr(int(val))*(nSamples-pos))
+    return b"".join(out)
+  def chord_numpy(halfPeriods,nSamples,amp):
+    times,deltas = [],[]
+    for hp in halfPeriods:
+      t = (numpy.arange(1,int(nSamples/hp)+2)*hp).astype(int)
+      t = t[t < nSamples]
+      d = numpy.empty(len(t),numpy.array(amp).dtype)
+      d[0::2],d[1::2] = amp,-amp
+      times.append(t) ; deltas.append(d)
+    times = numpy.concatenate(times)
+    if not len(times): return bchr(0)*nSamples
+    order = numpy.argsort(times,kind='mergesort') # stable, keeps voice order within a sample
+    times = times[order]
+    vals = numpy.cumsum(numpy.concatenate(deltas)[order]) # sequential, so rounds like the per-sample loop
+    lastAtTime = numpy.append(times[1:] != times[:-1],True)
+    starts = numpy.append(0,times[lastAtTime])
+    levels = numpy.append(0,vals[lastAtTime]).astype(int).astype(numpy.uint8)
+    return numpy.repeat(levels,numpy.diff(numpy.append(starts,nSamples))).tobytes()
+  def numSamples(millisecs):
+    samples = millisecs * rate / 1000
+    n = int(samples)
+    if n < samples: n += 1 # (we write sample t for all t < samples)
+    return n
+  def square(noteNos,millisecs): return chord(list(map(to_freq,noteNos)),millisecs)
+  # Band-limited alternative: one cycle of a square wave per
+  # MIDI note, summed from only those odd harmonics that are
+  # below the Nyquist frequency at this rate (with Lanczos
+  # sigma factors to tame the Gibbs overshoot).  Tables are
+  # built on first use and then each chord costs a few numpy
+  # operations regardless of its length, with all the voices
+  # done together as the rows of one array.
+  wavetable_len = 2048
+  wavetables = {} ; wavetable_phases = {}
+  def get_wavetable(n):
+    n = min(127,int(math.ceil(n))) # round bent notes up so their harmonics stay below Nyquist
+    if not n in wavetables:
+      f = midi_note_to_freq[n]
+      h = numpy.arange(1,int(min(rate/2.0/f,wavetable_len/2))+1,2)
+      x = numpy.arange(wavetable_len+1)*(2*math.pi/wavetable_len) # +1 so we can interpolate past the end
+      w = numpy.dot(numpy.sinc(h/(h[-1]+2.0))/h,numpy.sin(numpy.outer(h,x)))
+      w = w/abs(w).max()
+      wavetables[n] = w[:-1],numpy.diff(w) # and the slope from each point to the next, for interpolating
+    return wavetables[n]
+  def wavetable(noteNos,millisecs):
+    nSamples = numSamples(millisecs)
+    for n in list(wavetable_phases.keys()):
+      if not n in noteNos: del wavetable_phases[n]
+    if not noteNos: return bchr(0)*nSamples
+    amp = aplay/2.0/len(noteNos)
+    start = numpy.array([wavetable_phases.get(n,0) for n in noteNos])[:,None]
+    step = numpy.array([to_freq(n)/rate for n in noteNos])[:,None]
+    ph = start+numpy.arange(nSamples+1)*step
+    ph -= numpy.floor(ph) ; ph *= wavetable_len # (the same as % 1.0 for positive phases, but faster)
+    idx = ph[:,:-1].astype(int) ; frac = ph[:,:-1]-idx
+    tables = [get_wavetable(n) for n in noteNos]
+    idx += numpy.arange(0,len(tables)*wavetable_len,wavetable_len)[:,None] # (row i indexes the i'th table below)
+    values = numpy.concatenate([t for t,_ in tables]).take(idx)
+    slopes = numpy.concatenate([d for _,d in tables]).take(idx)
+    out = (amp*(1+values+slopes*frac)).sum(axis=0) # (adding the voices in order, as one at a time did)
+    for n,p in zip(noteNos,ph[:,-1]): wavetable_phases[n] = p/wavetable_len # continue the cycle if the note is held into the next chord
+    return numpy.clip(out,0,255).astype(numpy.uint8).tobytes()
+  oscillators = {"square":square, "wavetable":wavetable}
+  if not aplay_osc in oscillators: raise Exception("Unknown --osc "+aplay_osc+" (choose from "+", ".join(sorted(oscillators.keys()))+")")
+  if aplay_osc=="wavetable" and not numpy:
+    sys.stderr.write("--osc wavetable needs numpy: using square\n") ; aplay_osc = "square"
+  oscillator = oscillators[aplay_osc]
   def add_midi_note_chord(noteNos,microsecs):
-    chord(list(map(to_freq,noteNos)),microsecs / 1000)
-elif bbc_micro or acorn_electron:
+    b = oscillator(noteNos,scheduler.length(microsecs))
+    scheduler.took(len(b)*1000.0/rate)
+    if scheduler.t0 is None: scheduler.start()
+    o.write(b) ; scheduler.wait(len(b)*1000.0/rate,False) # (aplay's buffer paces us)
+  def aplay_finish():
+    aplay_pipe.close() # waits for aplay to finish playing
+    if not scheduler.t0 is None: scheduler.wait(0,False)
+  if aplay_buffer:
+    # 3-stage pipeline: the main thread parses and queues
+    # chords, a renderer thread turns them into samples, and
+    # a writer thread feeds aplay from a bounded queue, so a
+    # dense passage in the parser need not cause a gap.
+    import threading
+    try: import queue
+    except ImportError: import Queue as queue # Python 2
+    chordQ,sampleQ = queue.Queue(aplay_buffer*4),queue.Queue(aplay_buffer)
+    underruns = [0]
+    def renderer():
+      while True:
+        c = chordQ.get()
+        if c is None: return sampleQ.put(None)
+        sampleQ.put(oscillator(*c))
+    def writer():
+      start,written = None,0
+      while True:
+        b = sampleQ.get()
+        if b is None: return
+        elif not b: continue
+        now = monotonic() # (not time.time, which jumps if the clock is set)
+        if start is None or written < (now-start)*rate:
+          if not start is None: underruns[0] += 1 # aplay will have run out of samples before we got this block
+          start,written = now,0
+        if scheduler.t0 is None: scheduler.start()
+        o.write(b) ; written += len(b)
+        scheduler.wait(len(b)*1000.0/rate,False)
+    threads = [threading.Thread(target=renderer),threading.Thread(target=writer)]
+    for t in threads:
+      t.daemon = True # (don't hang if the main thread fails)
+      t.start()
+    def add_midi_note_chord(noteNos,microsecs):
+      millisecs = scheduler.length(microsecs)
+      scheduler.took(numSamples(millisecs)*1000.0/rate)
+      chordQ.put((noteNos,millisecs))
+    def aplay_finish():
+      chordQ.put(None)
+      for t in threads: t.join()
+      aplay_pipe.close()
+      if not scheduler.t0 is None: scheduler.wait(0,False)
+      sys.stderr.write("aplay buffer of %d chords had %d underruns\n" % (aplay_buffer,underruns[0]))
+
+def setupBBC():
+  global bbc_micro,current_array,bbc_binary,bbc_files
+  global keystroke_limit,bbc_chords,bbc_layouts,bbc_bass
+  global bbc_prepass,add_midi_note_chord,bbcFlush,init
   # This is a compact BBC Micro program to multiplex up to
   # 9 channels of sound onto the BBC Micro's 3 channels.
   # Basically uses ENVELOPEs to do the pitch multiplexing.
@@ -218,7 +481,7 @@ U.D%=0:END"""] # the 126,etc is there so that if this program is accidentally ru
     bbc_binary = 1
     bbc_files = []
   elif bbc_binary: # don't use AUTO; change to read RAM
-    lines = ("E%=TOP:" + bbc_micro[0]).split("\n") ; bbc_micro = []
+    lines = bbcRepeatsPlayer("E%=TOP:G%=0:" + bbc_micro[0]).split("\n") ; bbc_micro = []
     for i in range(len(lines)):
       bbc_micro.append("%d%s" % (i+1,lines[i]))
     bbc_micro=[
@@ -228,7 +491,8 @@ U.D%=0:END"""] # the 126,etc is there so that if this program is accidentally ru
     # For larger MIDIs, can see sound queues etc (but not BASIC stack) via: MO.6:V.23;12;0;0;0;0;23;0;0;0;0;0:RUN
     # (can also try MO.4)
     bbc_micro = ["\n".join(bbc_micro).replace("READ D%","D%=?E%:E%=E%+1")]
-  keystroke_limit = 238
+  keystroke_limit = 238 ; bbc_chords,bbc_layouts = [],{} # (for bbcFlush)
+  bbc_bass,bbc_prepass = None,{"chords":0,"low":0,"polyphony":0,"aboveBass":0} # (bbc_bass is decided by bbcFlush)
   if bbc_sdl: keystroke_limit -= 5 # assuming up to 3 keystrokes for the backward-compatibility line number (can be up to 5, but if it gets as high as 4 then we're looking at a 230k+ program which is not going to fit in any version of the BBC Micro anyway so we might as well disregard the BBC Micro's keystroke buffer limit), + 2 keystrokes for "D." to "DATA"
   def add_midi_note_chord(noteNos,microsecs):
     duration = int((microsecs*20+500000)/1000000)
@@ -236,38 +500,135 @@ U.D%=0:END"""] # the 126,etc is there so that if this program is accidentally ru
       add_midi_note_chord(noteNos,254*1000000/20)
       duration -= 254
     if not duration: return
-    def f(n): # convert to SOUND/4 and bound the octaves
-      n -= 47 # MIDI note 69 (A4) is pitch 88 i.e. 4*22
-      while n<0: n+=12 # TODO: unless we want to make a bass line using SOUND 0,-V,3,D with SOUND 1,E,P+188,D (won't work on acorn_electron; envelope E will have to set its volume params to 0, or stick with single note), or SO.0,-V,2,D for approx. 1 tone below note 0 (which doesn't tie up channel 1).  Would need to know total number of notes there'll be before deciding if can do this.  Anyway such low notes are rather indistinct on BBC hardware.
-      while n>=63: n-=12 # we're using 63 for rest
-      return n
-    if acorn_electron: noteNos = noteNos[-3:]
-    noteNos = list(map(f,noteNos[-9:]))
-    while len(noteNos)<3: noteNos.append(63)
-    if bbc_sdl and (len(noteNos)>6 or (acorn_electron and len(noteNos)>2)) and not '1.13+' in bbc_micro[0]:
+    if bbc_sdl and (acorn_electron or len(noteNos[-9:])>6) and not '1.13+' in bbc_micro[0]:
       bbc_micro[0]="REM As there are chords with three\nREM notes per channel, you will need\nREM BBC SDL 1.13+ or 'real' BBCBASIC\nREM for the ENVELOPEs to sound right.\nREM\n"+bbc_micro[0] # see bbcsdl bug #3
-    if not acorn_electron:
-      # Divide the notes evenly among BBC channels,
-      # and if need arpeggiation, prefer it in the bass.
-      for a,b in [(9,0),(7,0),(9,3),(8,3),(9,6),(9,6)]:
-        if len(noteNos)<a: noteNos.insert(len(noteNos)-b,63)
+    # This is the first pass: keep the chord for bbcFlush,
+    # and the statistics it needs to choose how to encode
+    # them (in constant time, so big files stay fast)
+    noteNos = tuple(noteNos) ; bbc_chords.append((noteNos,duration))
+    if noteNos:
+      s = bbc_prepass ; low = noteNos[0] < 47 # (below the tone channels)
+      s["chords"] += 1 ; s["low"] += low
+      s["polyphony"] = max(s["polyphony"],len(noteNos))
+      s["aboveBass"] = max(s["aboveBass"],len(noteNos)-low)
+  def f(n): # convert to SOUND/4 and bound the octaves
+    n -= 47 # MIDI note 69 (A4) is pitch 88 i.e. 4*22
+    while n<0: n+=12 # (unless bbc_bass puts it on the noise channel; such low notes are rather indistinct on BBC hardware anyway)
+    while n>=63: n-=12 # we're using 63 for rest
+    return n
+  def bbcArpeggio(notes): # one channel's notes, as a triple
+    notes = notes+[63]*(3-len(notes))
     # Check range of arpeggiation pitch increments, adjust
     # octave as needed (too high shouldn't happen in
     # sensible music, but double-bass too low is possible)
-    for i in range(0,len(noteNos),3):
-      for j in range(i+1,i+3):
-        if noteNos[j]==63: break
-        while noteNos[j]>noteNos[j-1]+31: noteNos[j]-=12
-        while noteNos[j]<noteNos[j-1]-32: noteNos[j]+=12
+    for j in (1,2):
+      if notes[j]==63: break
+      while notes[j]>notes[j-1]+31: notes[j]-=12
+      while notes[j]<notes[j-1]-32: notes[j]+=12
+    return tuple(notes)
+  def bbcLayouts(noteNos):
+    # The ways of laying out the chord in c% (with the
+    # same number of notes arpeggiated in each channel),
+    # the usual one first
+    if acorn_electron: return [bbcArpeggio(list(map(f,noteNos[-3:])))]
+    if bbc_bass: return bbcBassLayouts(noteNos)
+    noteNos = list(map(f,noteNos[-9:]))
+    while len(noteNos)<3: noteNos.append(63)
+    # Divide the notes evenly among BBC channels,
+    # and if need arpeggiation, prefer it in the bass.
+    for a,b in [(9,0),(7,0),(9,3),(8,3),(9,6),(9,6)]:
+      if len(noteNos)<a: noteNos.insert(len(noteNos)-b,63)
+    notes = [n for n in noteNos if not n==63]
+    sizes = [[3-noteNos[i:i+3].count(63) for i in (0,3,6)]]
+    # but the channels can be in any order (and with
+    # bbc_allocate 2 any of them can have the extra notes)
+    if bbc_allocate==2: sizes += list(itertools.permutations(sizes[0]))
+    if bbc_allocate: orders = list(itertools.permutations((0,1,2)))
+    else: orders = [(0,1,2)]
+    seen,layouts = set(),[]
+    for s0,s1,s2 in sizes:
+      triples = [bbcArpeggio(g) for g in (notes[:s0],notes[s0:s0+s1],notes[s0+s1:])]
+      for a,b,c in orders:
+        layout = triples[a]+triples[b]+triples[c]
+        if not layout in seen: seen.add(layout) ; layouts.append(layout)
+    return layouts
+  def bbcBassLayouts(noteNos):
+    # As bbcLayouts when bbc_bass: c%(0) is the MIDI note
+    # for the noise channel (c%(1) and c%(2) stay silent),
+    # and up to 6 others go to channels 2 and 3
+    if noteNos and noteNos[0] < 47: bass,noteNos = (int(noteNos[0]),63,63),noteNos[1:]
+    else: bass = (63,63,63)
+    notes = list(map(f,noteNos[-6:])) ; s0 = (len(notes)+1)//2
+    sizes = [s0] # (arpeggiating the lower channel if odd)
+    if bbc_allocate==2 and len(notes)%2: sizes.append(s0-1)
+    seen,layouts = set(),[]
+    for s0 in sizes:
+      triples = [bbcArpeggio(notes[:s0]),bbcArpeggio(notes[s0:])]
+      for a,b in ([(0,1)],[(0,1),(1,0)])[bbc_allocate>0]:
+        layout = bass+triples[a]+triples[b]
+        if not layout in seen: seen.add(layout) ; layouts.append(layout)
+    return layouts
+  def bbcFlush():
+    # The second pass: decides (once per program) whether to
+    # play the bass on the noise channel, from bbc_prepass,
+    # then chooses a layout for each chord in bbc_chords
+    # with the fewest DATA bytes overall (by dynamic
+    # programming over the chords, as a layout can make the
+    # next one cheaper too), preferring the usual layouts,
+    # and writes them.
+    # Layouts are packed into integers (a byte per slot) so
+    # ((a^b)+K)&H has the top bit of each slot that changes,
+    # for looking up the bytes.  Costs are bytes<<36 + how
+    # many unusual layouts<<5 + the layout's index (<18) so
+    # the minimum of the next ones says where it came from.
+    global bbc_bass
+    if bbc_bass is None:
+      s = bbc_prepass ; bbc_layouts.clear() # (they depend on it)
+      if acorn_electron or bbc_sdl or bbc_noise_bass=="off": bbc_bass = False
+      elif bbc_noise_bass=="on": bbc_bass = True
+      else: bbc_bass = 0 < s["chords"] <= 4*s["low"] and s["aboveBass"] <= 6 # (so no note is dropped; also uses at most 2 envelopes a chord)
+      if bbc_bass:
+        sys.stderr.write("Playing the bass on the noise channel (%d of %d chords go below the tone channels)\n" % (s["low"],s["chords"]))
+        if not bbc_ssd: bbc_micro[0] = bbcNoiseBassPlayer(bbc_micro[0])
+      most,room = ((s["polyphony"],9),(s["aboveBass"],6))[bbc_bass]
+      if acorn_electron: room = 3
+      if most > room: sys.stderr.write("Chords have up to %d notes: playing the top %d\n" % (most,room))
+    if acorn_electron or not bbc_allocate: # nothing to choose
+      for noteNos,duration in bbc_chords: bbcWrite(bbcLayouts(noteNos)[0],duration)
+      del bbc_chords[:] ; return
+    chords = []
+    for noteNos,duration in bbc_chords:
+      if not noteNos in bbc_layouts:
+        layouts = [tuple(map(int,l)) for l in bbcLayouts(noteNos)] # (as the DATA will be; pitch bends can make them fractional)
+        bbc_layouts[noteNos] = [(bbcPack(l),l) for l in layouts]
+      chords.append((bbc_layouts[noteNos],duration))
+    n = len(current_array) ; K,H = bbcPack([0x7F]*n),bbcPack([0x80]*n)
+    table = dict((bbcPack([0x80*(m>>i&1) for i in range(n)]),bbcChordBytes([0]*n,[m>>i&1 for i in range(n)])<<36) for m in range(1<<n))
+    states = [(bbcPack(current_array),0)]
+    back = [] # for each chord, each layout's best previous one
+    for layouts,_ in chords:
+      costs = [min([c+table[((prev^new)+K)&H] for prev,c in states]) for new,_ in layouts]
+      back.append(bytearray(c&31 for c in costs))
+      states = [(layouts[k][0],(c>>5<<5)+((k>0)<<5)+k) for k,c in enumerate(costs)]
+    del bbc_chords[:]
+    if not chords: return
+    k = min(c for _,c in states)&31 ; chosen = []
+    for prevs in reversed(back):
+      chosen.append(k) ; k = prevs[k]
+    chosen.reverse()
+    for k,(layouts,duration) in zip(chosen,chords):
+      bbcWrite(layouts[k][1],duration)
+  def bbcWrite(noteNos,duration):
     # Now calculate the DATA numbers:
     o = [] ; curSkip = 0
-    for i in range(len(current_array)):
+    last = len(noteNos)-1
+    while last and noteNos[last]==current_array[last]: last -= 1
+    for i in range(last+1):
       if noteNos[i]==current_array[i] and o and curSkip<2:
         curSkip += 1 ; continue
       if curSkip: o[-1] += curSkip*64
       curSkip = 0 ; current_array[i] = noteNos[i]
-      if noteNos[i:] == current_array[i:]:
-        o.append(noteNos[i]+3*64) ; break # last change
+      if i==last: o.append(noteNos[i]+3*64) # last change
       else: o.append(noteNos[i])
     o.append(duration)
     if bbc_binary:
@@ -279,50 +640,88 @@ U.D%=0:END"""] # the 126,etc is there so that if this program is accidentally ru
   def init():
     global dedup_microsec_quantise
     dedup_microsec_quantise = 50000 # 1000000/20
-elif riscos_Maestro:
+
+def setupMaestro():
+  global allowed_BPMs,default_bpm,hemi_microsecs,maestroAdd
+  global add_midi_note_chord,maestroEncode,maestroData,init
   allowed_BPMs = [40, 50, 60, 65, 70, 80, 90, 100, 115, 130, 145, 160, 175, 190, 210]
-  default_bpm = max(allowed_BPMs) # theoretically gives the most accuracy
+  if maestro_bpm and not maestro_bpm=="auto":
+    default_bpm = int(maestro_bpm)
+    assert default_bpm in allowed_BPMs, "--maestro-bpm must be auto or one of "+", ".join(map(str,allowed_BPMs))
+  else: default_bpm = max(allowed_BPMs) # theoretically gives the most accuracy (and auto starts from here)
   hemi_microsecs = int(3750000/default_bpm) # for now (ms/hemi = beat/hemi / (b/min * min/microsec) = 1/16 / (bpm / 60000000) = 60000000/16/bpm)
-  def add_midi_note_chord(noteNos,microsecs):
-    noteNos.reverse()
+  def maestroAdd(noteNos,microsecs):
+    global maestro_moved,maestro_notes,current_chord
     global current_time
-    for n in current_chord[:]:
-      if n.noteNo in noteNos: noteNos.remove(n.noteNo) # just extend the currently-playing note
+    wanted = set(noteNos) ; kept = []
+    for n in current_chord:
+      if n.noteNo in wanted: # just extend the currently-playing note
+        kept.append(n) ; wanted.remove(n.noteNo)
       else: # stop that note:
-        assert n.noteNo not in noteNos # shouldn't have any duplicates in that list
+        s,e = n.startTime,current_time
         n.end(current_time)
         n.quantTo(hemi_microsecs)
+        maestro_moved += abs(n.startTime-s)+abs(n.endTime-e) ; maestro_notes += 1
         foundC = False
         for i in [0,4,6,2,1,3,5,7]: # allocate channels in that order so 2-stave (0-3,4-6/7), 3-stave (0,1-4,5-6/7) and 4-stave (0-1,2-3,4-5,6/7) views work vaguely sensibly
             c = riscos_channels[i]
             if not c or c[-1].endTime <= n.startTime:
                 c.append(n) ; foundC = True ; break
-        if not foundC: sys.stderr.write("Insufficient RISC OS channels: dropping note %d\n" % n.noteNo)
-        current_chord.remove(n)
-    for noteNo in noteNos: current_chord.append(MaestroMidiNote(noteNo,current_time)) # newly-started notes
+        if not foundC:
+          maestro_dropped.append(n.noteNo)
+          if not maestro_bpm=="auto": sys.stderr.write("Insufficient RISC OS channels: dropping note %d\n" % n.noteNo) # (auto reports them for the tempo it chooses)
+    if wanted:
+      for noteNo in reversed(noteNos):
+        if noteNo in wanted: kept.append(MaestroMidiNote(noteNo,current_time)) # newly-started notes
+    current_chord = kept
     current_time += microsecs
-  def maestroData():
+  if maestro_bpm=="auto": # keep the chords for maestroData to try each tempo
+    def add_midi_note_chord(noteNos,microsecs): maestro_chords.append((noteNos[:],microsecs))
+  else: add_midi_note_chord = maestroAdd
+  def maestroEncode():
+    global maestro_bars
+    maestro_bars = maestroBars()
     queues = []
     for c in riscos_channels:
-      timeCountFrom = 0 ; chan = []
-      barHemisLeft = 64 # assumes 4/4 with no anacrusis
+      timeCountFrom = 0 ; chan = bytearray()
+      bar = [0,maestroBarLength(0)] # bar number, hemis left in it
       for n in c:
-          nn,barHemisLeft = n.note(hemi_microsecs,timeCountFrom,barHemisLeft)
-          chan.append(nn)
+          n.note(hemi_microsecs,timeCountFrom,bar,chan)
           timeCountFrom = n.endTime
-      queues.append(''.join(chan))
+      queues.append(chan)
     staves = 0
     for q in queues:
       if q and staves<4: staves += 1 # helps with more accurate playing if each part has its own stave (pity there's a maximum of 4)
     if not staves: staves = 1
-    return Maestro_header+setBPM_block(default_bpm)+setVolumes_block()+musicData_block(queues)+setStaves_block(staves)+setInstruments_block()
-  if type("")==type(u""): # Python 3
-    maestroData_real = maestroData
-    def maestroData(): return maestroData_real().encode('latin1')
+    return bytes(Maestro_header+setBPM_block(default_bpm)+setVolumes_block()+musicData_block(queues)+setStaves_block(staves)+setInstruments_block())
+  def maestroData():
+    if not maestro_bpm=="auto": return maestroEncode()
+    # Try every tempo (--jobs at a time) and keep the
+    # smallest file that doesn't move notes by more than
+    # maestro_bpm_tolerance on average or drop more of them
+    # than the fastest tempo
+    if jobs > 1 and hasattr(os,'fork'):
+      import multiprocessing
+      if multiprocessing.current_process().daemon: tries = None # (already a --jobs worker)
+      else:
+        try: multiprocessing = multiprocessing.get_context("fork")
+        except AttributeError: pass
+        pool = multiprocessing.Pool(min(jobs,len(allowed_BPMs)))
+        tries = pool.map(maestroTry,allowed_BPMs) ; pool.close()
+    else: tries = None
+    if tries == None: tries = [maestroTry(bpm) for bpm in allowed_BPMs]
+    fastest = tries[allowed_BPMs.index(max(allowed_BPMs))]
+    data,bpm,moved,dropped = min([t for t in tries if t[2] <= maestro_bpm_tolerance*1000 and len(t[3]) <= len(fastest[3])]+[fastest],key=lambda t:(len(t[0]),-t[1]))
+    for n in dropped: sys.stderr.write("Insufficient RISC OS channels: dropping note %d\n" % n)
+    sys.stderr.write("(Maestro tempo %d: notes moved %.1fms on average) " % (bpm,moved/1000.0))
+    return data
   def init():
-    global current_chord,current_time,riscos_channels
-    current_chord = [] ; current_time = 0 ; riscos_channels = [[],[],[],[],[],[],[],[]]
-elif mac_voice:
+    global maestro_chords
+    maestro_chords = [] ; maestroReset()
+
+def setupMacVoice():
+  global force_monophonic,noteNoToPbas,minNote,maxNote,init
+  global add_midi_note_chord
   force_monophonic = 1
   if mac_voice=="Organ": noteNoToPbas,minNote,maxNote=lambda x:132.96*math.log(x+49.7)-565.5,46,74
   elif mac_voice=="Joelle": noteNoToPbas,minNote,maxNote=lambda x:66.3*math.log(x-14)-210,61,73 # TODO: do these values depend on the exact syllable?
@@ -362,7 +761,9 @@ elif mac_voice:
       b=os.popen('sox %d-1.wav -t raw -r 44100 -c 1 -b 16 -' % pid)
       pcmData[-1] = (b.buffer if hasattr(b,'buffer') else b).read()
       os.remove('%d-1.wav' % pid)
-elif voice_json:
+
+def setupJson():
+  global force_monophonic,init,add_midi_note_chord
   force_monophonic = 1
   def init():
     global SingWords,currentSpeaker,microsecsSoFar,sylsLeft
@@ -373,33 +774,35 @@ elif voice_json:
     sylsLeft = 0
     print('{"version":"1.0.0","segments":[')
   def setupNextWord():
+    global currentSpeaker,currentWord,sylsLeft
     isSpeaker = 0
     while True:
       word = SingWords.pop()
-      global currentSpeaker
       if word.startswith('[') or isSpeaker:
         if word.startswith('['): currentSpeaker=""
         currentSpeaker += word.replace("[","").replace("]","")
         isSpeaker = not word.endswith(']')
         if isSpeaker: currentSpeaker += " "
       else:
-        global currentWord,sylsLeft ; currentWord,sylsLeft = word.replace('-',''),len(word.split('-'))
+        currentWord,sylsLeft = word.replace('-',''),len(word.split('-'))
         if Anytime_Player_bug_workaround: # v1.3.5 drops space before single-letter words
           while SingWords and len(SingWords[-1])==1:
             currentWord += " "+SingWords.pop()
             sylsLeft += 1
         break
   def add_midi_note_chord(noteNos,microsecs):
-    global microsecsSoFar, sylsLeft, wordStartMS
+    global microsecsSoFar,wordStartMS,sylsLeft
     startM,microsecsSoFar = microsecsSoFar,microsecsSoFar+microsecs
     if not noteNos or not microsecs: return
     if not sylsLeft:
       wordStartMS = startM ; setupNextWord()
     sylsLeft -= 1
     if not sylsLeft: print('{"speaker":"%s","startTime":%g,"endTime":%g,"body":"%s"}%s' % (currentSpeaker,wordStartMS/1000000.0,microsecsSoFar/1000000.0,currentWord,(',' if SingWords else ((',{"speaker":"%s","startTime":%g,"endTime":%g,"body":""}' % (currentSpeaker,microsecsSoFar/1000000.0,microsecsSoFar/1000000.0)) if Anytime_Player_bug_workaround else '')))) # (v1.3.5 won't display last word so add a placebo)
-elif qbasic:
+
+def setupQbasic():
+  global init,add_midi_note_chord
   def init():
-    global basData, dedup_microsec_quantise
+    global basData,dedup_microsec_quantise
     basData = [b'PLAY "T255L64MLMB"']
     dedup_microsec_quantise = 60000000/255/(64/4)
     basData+=[b'ON PLAY(1) GOSUB playTune\nr=0:PLAY ON:GOSUB playTune\nPRINT "Press any key to stop"\nDO: LOOP UNTIL INKEY$ <> ""\nEND\nplayTune:\nIF r<=0 THEN READ p$,r\nIF p$ = "@" THEN END\nPLAY p$\nr = r - 1\nRETURN'] # Won't work in the earlier GW-BASIC: yes you can number the lines (including for the GOSUB), rewrite the loop to WHILE INKEY$="":WEND, and paste into DOSBox to work around gwbasic being unable to load this program from a text file, but the ON PLAY check gets dropped after about 1 chord.
@@ -414,16 +817,21 @@ elif qbasic:
     notes = b"%s,%d" % (b"".join(notes),max(1,int(microsecs/dedup_microsec_quantise/len(notes))))
     if basData and basData[-1].startswith(b"DATA ") and len(basData[-1])+len(notes) < 79: basData[-1] += b","+notes # 80th col is scrollbar
     else: basData.append(b"DATA "+notes)
-elif grub:
+
+def setupGrub():
+  global pulselength_milliseconds,bpm,grub_tune_file,grub_out
+  global grub,init,add_midi_note_chord
   pulselength_milliseconds = 10
   bpm = int(60000/pulselength_milliseconds)
   assert pulselength_milliseconds == int(60000/bpm), "rounding error with this pulselength"
-  if os.path.exists('/boot/grub2'): grub="grub2" # Red Hat etc
+  grub_tune_file = os.environ.get("GRUB_TUNE",grub_tune_file)
+  if grub_tune_file: grub_out = open(grub_tune_file,"wb")
+  elif os.path.exists('/boot/grub2'): grub="grub2" # Red Hat etc
   elif os.path.exists('/boot/grub'): grub="grub" # Debian
   else: raise Exception("Can't find GRUB on this system")
-  grub_out = os.popen("sudo bash -c '(grep -v ^GRUB_INIT_TUNE < /etc/default/grub;echo GRUB_INIT_TUNE=\\\"/boot/"+grub+"/tune\\\")>/etc/default/grub0;mv /etc/default/grub0 /etc/default/grub;cat > /boot/"+grub+"/tune;if [ -e /boot/efi/EFI/redhat/grub.cfg ]; then grub2-mkconfig -o /boot/efi/EFI/redhat/grub.cfg; else "+grub+"-mkconfig -o /boot/"+grub+"/grub.cfg; fi'","w")
+  if not grub_tune_file: grub_out = os.popen("sudo bash -c '(grep -v ^GRUB_INIT_TUNE < /etc/default/grub;echo GRUB_INIT_TUNE=\\\"/boot/"+grub+"/tune\\\")>/etc/default/grub0;mv /etc/default/grub0 /etc/default/grub;cat > /boot/"+grub+"/tune;if [ -e /boot/efi/EFI/redhat/grub.cfg ]; then grub2-mkconfig -o /boot/efi/EFI/redhat/grub.cfg; else "+grub+"-mkconfig -o /boot/"+grub+"/grub.cfg; fi'","w")
   try: gWrap,grub_out = grub_out,grub_out.buffer # Python 3
-  except AttributeError: pass # Python 2
+  except AttributeError: pass # Python 2 (or a file)
   grub_out.write(pack('<I',bpm))
   def init():
     global dedup_microsec_quantise
@@ -436,7 +844,11 @@ elif grub:
     else:
       for _ in xrange(max(1,int(millisecs/(len(freqs)*pulselength_milliseconds)))):
         for f in freqs: grub_out.write(pack('<HH',int(f),1))
-else: # beep
+
+def setupBeep():
+  global event,beep_device,init,min_pulseLength,max_pulseLength
+  global repetitions_to_aim_for,command_line_len,runBeep
+  global add_midi_note_chord,beep_fd
   # NSLU2 hack:
   try: event=open("/proc/bus/input/devices").read()
   except IOError: event=""
@@ -445,20 +857,32 @@ else: # beep
     event="-e /dev/input/"+(h[:h.find("\n")].split()[-1])
     os.system("sync") # just in case (beep has been known to crash NSLU2 Debian Etch in rare conditions)
   else: event=""
+  beep_device = os.environ.get("BEEP_DEVICE",event[3:])
 
   def init():
     global cumulative_params
     cumulative_params = []
   min_pulseLength, max_pulseLength = 10,20 # milliseconds
   repetitions_to_aim_for = 1 # arpeggiating each chord only once will do if it's brief
+  def arpeggio(freqList,millisecs):
+    # returns pulse length and number of pulses
+    pulseLength = max(min(millisecs/len(freqList)/repetitions_to_aim_for,max_pulseLength),min_pulseLength)
+    if drift_compensation: return pulseLength,max(1,int(millisecs/pulseLength)) # can stop part way through the chord (and the scheduler carries the rest): at least 1 pulse, but very short chords could still be dropped to catch up
+    return pulseLength,len(freqList)*max(1,int(millisecs/pulseLength/len(freqList))) # (max with 1 means at least 1 repetition - prefer a slight slow-down to missing a chord out)
   def chord(freqList,millisecs):
     if not millisecs: return ""
     elif not freqList: return " -D %d" % (millisecs,) # rest
     elif len(freqList)==1: return " -n -f %d -l %d" % (freqList[0],millisecs) # one note
     else:
-        pulseLength = max(min(millisecs/len(freqList)/repetitions_to_aim_for,max_pulseLength),min_pulseLength)
-        return (" -D 0".join([chord([f],pulseLength) for f in freqList]))*max(1,int(millisecs/pulseLength/len(freqList))) # (max with 1 means at least 1 repetition - prefer a slight slow-down to missing a chord out)
+        pulseLength,nPulses = arpeggio(freqList,millisecs)
+        notes = [chord([f],pulseLength) for f in freqList]
+        reps,part = divmod(nPulses,len(notes))
+        return (" -D 0".join(notes))*reps + " -D 0".join(notes[:part])
     # (the above -D 0 is necessary because Debian 5's beep adds a default delay otherwise)
+  def chordLength(freqList,millisecs): # what beep will actually play for chord()
+    if len(freqList) < 2: return int(millisecs)
+    pulseLength,nPulses = arpeggio(freqList,millisecs)
+    return int(pulseLength)*nPulses
 
   command_line_len = 80000 # reduce this if you get "argument list too long" (NB the real limit is slightly more than this value)
 
@@ -471,34 +895,267 @@ else: # beep
         os.system("beep "+event+" "+thisP)
 
   def add_midi_note_chord(noteNos,microsecs):
-    millisecs = microsecs / 1000
+    millisecs = scheduler.length(microsecs)
     if noteNos and cumulative_params and not "-D" in cumulative_params[-1].split()[-2:]: cumulative_params.append("-D 0") # necessary because Debian 5's beep adds a default delay otherwise
-    cumulative_params.append(chord(list(map(to_freq,noteNos)),millisecs))
+    freqs = list(map(to_freq,noteNos))
+    cumulative_params.append(chord(freqs,millisecs))
+    if millisecs: scheduler.took(chordLength(freqs,millisecs))
 
-def make_bbcMicro_DFS_image(datFiles):
+  if beep_direct:
+    # Keep the device open for the whole run and time the
+    # notes ourselves, instead of forking "beep" per chunk.
+    # cumulative_params is then a list of (freq,millisecs)
+    # with freq 0 for silence.
+    if beep_device: devices = [beep_device]
+    else: devices = ["/dev/tty0","/dev/vc/0","/dev/console"] # as beep tries
+    beep_fd = None
+    for d in devices:
+      try: beep_fd = os.open(d,os.O_WRONLY) ; break
+      except OSError: pass
+    if beep_fd is None: raise Exception("Can't open "+" or ".join(devices)+" for writing (try BEEP_DEVICE or run without --direct)")
+    try:
+      import fcntl
+      fcntl.ioctl(beep_fd,0x4B2F,0) # KIOCSOUND: PC speaker via the console
+      def setTone(freq):
+        if freq: fcntl.ioctl(beep_fd,0x4B2F,int(1193180/freq))
+        else: fcntl.ioctl(beep_fd,0x4B2F,0)
+    except (ImportError,IOError,OSError): # an input event device, e.g. ixp4xx beeper (or a regular file)
+      def setTone(freq):
+        t = time.time()
+        os.write(beep_fd,pack('llHHi',int(t),int((t%1)*1000000),0x12,2,int(freq))) # EV_SND, SND_TONE
+    def add_midi_note_chord(noteNos,microsecs):
+      millisecs = scheduler.length(microsecs*1.0)
+      if not millisecs: return
+      freqs = list(map(to_freq,noteNos))
+      if len(freqs) < 2: cumulative_params.append((freqs and freqs[0] or 0,millisecs))
+      else:
+        pulseLength,nPulses = arpeggio(freqs,millisecs)
+        cumulative_params.extend(([(f,pulseLength) for f in freqs]*(nPulses//len(freqs)+1))[:nPulses])
+        millisecs = pulseLength*nPulses
+      scheduler.took(millisecs)
+    def runBeep(tones):
+      while tones and not tones[0][0]: tones = tones[1:] # as beep: no initial silence
+      scheduler.start() ; lastFreq = None
+      try:
+        for freq,millisecs in tones:
+          if not freq==lastFreq: setTone(freq) ; lastFreq = freq
+          scheduler.wait(millisecs) # (from the start, so errors don't accumulate)
+      finally: setTone(0)
+
+def bbcChordBytes(prev,new):
+  # How many DATA numbers bbcWrite needs to change c% from
+  # prev to new: c%(0) is always written, then every change
+  # (and every 3rd slot of a run that doesn't change), then
+  # the duration
+  p,count = 0,2
+  for i in range(1,len(new)):
+    if not new[i]==prev[i]:
+      count += (i-p-1)//3+1 ; p = i
+  return count
+
+def bbcPack(layout): # for bbcFlush
+  return sum(v<<(8*i) for i,v in enumerate(layout))
+
+def bbcRepeats(data):
+  # Replaces runs of chords in --bbc-binary data that repeat
+  # earlier ones with a back-reference for the player: a
+  # chord that only sets c%(0) to what it already is, with
+  # duration 255, then 2 bytes of how far back the run starts
+  # (from the byte after the 255) and 2 of its length.  As
+  # chords are coded as changes to c%, a run can be repeated
+  # only where c% was the same before it, and it must be one
+  # that's written out (the player doesn't nest them).
+  c = [63]*len(current_array) ; recs,states = [],[] ; i = 0
+  while i < len(data): # split into chords, as the player reads them
+    states.append(tuple(c)) ; C,start = 0,i
+    while True:
+      c[C] = data[i] & 63 ; C += (data[i] >> 6)+1 ; i += 1
+      if data[i-1] >= 192: break # (increment of 4)
+    i += 1 # duration
+    recs.append(tuple(data[start:i]))
+  out,pos,runs,n,j = [],{},{},len(recs),0 # (pos = where each chord written out is)
+  while j < n:
+    bestL = bestBytes = 0
+    if j+1 < n:
+      for i in reversed(runs.get((states[j],recs[j],recs[j+1]),[])[-32:]): # (latest first)
+        L = size = 0
+        while j+L < n and i+L in pos and i+L < j and recs[i+L]==recs[j+L] and size+len(recs[j+L]) <= 32767: # (J% is signed)
+          size += len(recs[j+L]) ; L += 1
+        if size > bestBytes: bestL,bestI,bestBytes = L,i,size
+    dist = bestBytes and len(out)+2-pos[bestI]
+    if bestBytes > 6 and dist <= 65535:
+      out += [states[j][0]+192,255,dist&255,dist>>8,bestBytes&255,bestBytes>>8]
+      j += bestL
+    else:
+      pos[j] = len(out) ; out += recs[j]
+      if j+1 < n: runs.setdefault((states[j],recs[j],recs[j+1]),[]).append(j)
+      j += 1
+  return out
+
+def bbcRepeatsPlayer(program):
+  # Adds back-reference handling to the player (bbc_binary
+  # form, before READ is changed to indirection): F% is where
+  # to go back to when E% reaches G%
+  program = program.replace("REP.C%=0\n","REP.REP.C%=0:IF E%=G%:E%=F%\n")
+  return program.replace("\nREAD D%\n","\nREAD D%:IF D%=255:J%=!E%:F%=E%+4:E%=E%-(J% AND 65535):G%=E%+J% DIV 65536\nU.D%<255\n")
+
+def bbcNoiseBassPlayer(program):
+  # Makes the player sound c%(0) on the noise channel as
+  # periodic noise (3), which is pitched at channel 1's
+  # frequency /15, i.e. 47 semitones down: so channel 1
+  # plays c%(0) silently (without an envelope), and all 4
+  # channels are synchronised
+  program = program.replace("FOR I%=0 TO 6 STEP 3","SO.768,10*(c%(0)<>252),3,D%:FOR I%=0 TO 6 STEP 3")
+  program = program.replace("IF c%(I%)=252:V%=0","IF c%(I%)=252 OR I%=0:V%=0")
+  return program.replace("SO.513+","SO.769+")
+
+bbc_implied = {0:"BRK",8:"PHP",10:"ASLA",0x18:"CLC",0x28:"PLP",0x2A:"ROLA",0x38:"SEC",0x40:"RTI",0x48:"PHA",0x4A:"LSRA",0x58:"CLI",0x60:"RTS",0x68:"PLA",0x6A:"RORA",0x78:"SEI",0x88:"DEY",0x8A:"TXA",0x98:"TYA",0x9A:"TXS",0xA8:"TAY",0xAA:"TAX",0xB8:"CLV",0xBA:"TSX",0xC8:"INY",0xCA:"DEX",0xD8:"CLD",0xE8:"INX",0xEA:"NOP",0xF8:"SED"} # 1-byte instructions that can stand in for an EQUB
+bbc_immediate = {0x69:"ADC#",0xA0:"LDY#",0xA2:"LDX#",0xA9:"LDA#",0xC0:"CPY#",0xC9:"CMP#",0xE0:"CPX#",0xE9:"SBC#"}
+bbc_absolute = {0x0E:"ASL",0x2C:"BIT",0x2E:"ROL",0x4E:"LSR",0x6D:"ADC",0x6E:"ROR",0x8C:"STY",0x8D:"STA",0x8E:"STX",0xAC:"LDY",0xAD:"LDA",0xAE:"LDX",0xCC:"CPY",0xCD:"CMP",0xCE:"DEC",0xEC:"CPX",0xED:"SBC",0xEE:"INC"} # (not AND, EOR or ORA, as BASIC would tokenise them)
+bbc_zeroPage = dict((k-8,v) for k,v in bbc_absolute.items()) # (used instead of absolute if the address is below 256)
+bbc_jumps = {0x20:"JSR",0x4C:"JMP"} # (always absolute)
+bbc_equs_chars = set(ord(c) for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789 !#$%&'()*+,-./;<=>?@") # (not " or : or [ ], or anything an emulator might not type)
+def bbcNum(v): # shorter of decimal and hex
+  d,h = str(v),"&%X" % v
+  if v >= 0x80000000 or len(h) < len(d): return h # (BASIC's integers are signed)
+  return d
+
+def bbcEquItems(data):
+  # Returns [OPT2 statements that assemble to data with the
+  # fewest keystrokes (each statement also costing 1 for its
+  # : or ]), choosing by dynamic programming among EQUB/W/D,
+  # 6502 instructions that assemble to the same bytes, and
+  # EQUS for runs of printable bytes
+  n = len(data)
+  best,how = [0]*(n+1),[None]*(n+1) # best[i] = keystrokes for data[i:]
+  inStr,strHow = [2]*(n+1),[False]*(n+1) # the same if a string is open before data[i] (2 = closing " and :)
+  for i in range(n-1,-1,-1):
+    b = data[i] ; cands = [(bbc_implied.get(b) or "EQUB"+bbcNum(b),1)]
+    if i+1 < n:
+      cands.append(("EQUW"+bbcNum(b|data[i+1]<<8),2))
+      o = bbc_immediate.get(b) or bbc_zeroPage.get(b)
+      if o: cands.append((o+bbcNum(data[i+1]),2))
+    if i+2 < n:
+      o = bbc_jumps.get(b) or (data[i+2] and bbc_absolute.get(b))
+      if o: cands.append((o+bbcNum(data[i+1]|data[i+2]<<8),3))
+    if i+3 < n: cands.append(("EQUD"+bbcNum(b|data[i+1]<<8|data[i+2]<<16|data[i+3]<<24),4))
+    best[i],how[i] = min((len(t)+1+best[i+l],(t,l)) for t,l in cands)
+    if b in bbc_equs_chars:
+      if 6+inStr[i+1] < best[i]: best[i],how[i] = 6+inStr[i+1],None # EQUS" and data[i] then the rest of the string
+      if 1+inStr[i+1] < 2+best[i]: inStr[i],strHow[i] = 1+inStr[i+1],True
+    if not strHow[i]: inStr[i] = 2+best[i] # (string closes before data[i])
+  items,i = [],0
+  while i < n:
+    if how[i]: items.append(how[i][0]) ; i += how[i][1]
+    else:
+      j = i+1
+      while j < n and strHow[j]: j += 1
+      items.append('EQUS"'+"".join(chr(c) for c in data[i:j])+'"') ; i = j
+  return items
+
+def bbcEquLines(data):
+  # bbcEquItems packed into [OPT2 lines, splitting EQUS to fill them
+  lines,cur = [],"[OPT2"
+  for item in bbcEquItems(data):
+    room = keystroke_limit-len(cur)-2 # (: and ])
+    while item.startswith("EQUS") and len(item) > room >= 8:
+      cur += ':'+item[:room-1]+'"' ; item = 'EQUS"'+item[room-1:]
+      lines.append(cur+']') ; cur = "[OPT2" ; room = keystroke_limit-len(cur)-2
+    if len(item) > room: lines.append(cur+']') ; cur = "[OPT2"
+    cur += ':'+item
+  if not cur=="[OPT2": lines.append(cur+']')
+  return lines
+
+def bbcInputLoopLines(data):
+  # The first 100*k bytes as hex for an input loop (EVAL'ing
+  # 8 digits at a time), and the rest as bbcEquLines
+  lines = ['REP.I.A$:IF LEN(A$):F.A%=1TO193STEP8:!P%=EVAL("&"+MID$(A$,A%,8)):P%=P%+4:N.:U.RIGHT$(A$,1)="*":EL.:U.0'] # horrible mix of if/else and repeat/until on 1 line in immediate mode so it copes with any extra blank lines that buggy emulators might insert
+  hexLen = 100*((len(data)-1)//100)
+  for i in range(0,hexLen,100):
+    lines.append("".join("%02X%02X%02X%02X" % (data[j+3],data[j+2],data[j+1],data[j]) for j in range(i,i+100,4))) # LSB-MSB
+  if hexLen: lines[-1] += '*'
+  return lines+bbcEquLines(data[hexLen:])
+
+def bbcTokenisedLine(lineNo,tokens):
+  assert len(tokens) <= 251, "tokenised line too long"
+  return "\r"+chr(lineNo>>8)+chr(lineNo&0xFF)+chr(len(tokens)+4)+tokens
+
+def bbcDfsProgram(datBytes,bass=False):
+  lomem_set = "\xd2=\xb8P+"+str(len(datBytes)-1)
+  assert not acorn_electron, "make_bbcMicro_DFS_image is hard-coded to use the BBC Micro reader, not Electron"
+  # This essentially tokenises the program with the 'abbreviated' version of the loop (with indirection instead of READ, and bbcRepeatsPlayer's changes):
+  line27 = "\xfdD%<255:\xf5:\xfd\x96-6>3:\xe3I%=0\xb86\x883:S%=0:T%=0:\xe7c%(I%)=252:V%=0:\x8b\xe7c%(I%+1)=252:V%=1:\x8bS%=1:Q%=c%(I%+1)-c%(I%):\xe7c%(I%+2)=252:V%=2:\x8bR%=c%(I%+2)-c%(I%+1):T%=1:V%=3"
+  line50 = "\xd4513+(I%\x813),V%,c%(I%),D%:\xed:\xfdD%=0"
+  if bass: # bbcNoiseBassPlayer's changes
+    line27 = line27.replace("\xe3I%=0","\xd4768,10*(c%(0)<>252),3,D%:\xe3I%=0").replace("252:V%=0","252\x84I%=0:V%=0")
+    line50 = line50.replace("\xd4513","\xd4769")
+  return "".join([
+    bbcTokenisedLine(0,lomem_set),
+    bbcTokenisedLine(10,"E%=\xb8P:G%=0:\xe3C%=16\xb819:\xd4C%,0,0,0:\xed:N%=0:\xdec%(8):\xe3D%=0\xb88:c%(D%)=252:\xed"),
+    bbcTokenisedLine(20,"\xf5:\xf5:C%=0:\xe7E%=G%:E%=F%"),
+    bbcTokenisedLine(25,"\xf5:D%=?E%:E%=E%+1:c%(C%)=(D%\x8063)*4:I%=(D%\x8164)+1:C%=C%+I%:\xfdI%=4:D%=?E%:E%=E%+1:\xe7D%=255:J%=!E%:F%=E%+4:E%=E%-(J%\x8065535):G%=E%+J%\x8165536"),
+    bbcTokenisedLine(27,line27),
+    bbcTokenisedLine(30,"\xe7V%:V%=V%*24+55:N%=N%+1:\xe7N%=17:N%=1"),
+    bbcTokenisedLine(40,"\xe7V%:\xe2N%,3,0,Q%,R%,1,S%,T%,V%,0,0,-V%,V%,V%:V%=N%"),
+    bbcTokenisedLine(50,line50),
+    "\r\xff",datBytes])
+
+def bbcDfsBoot(fnames,side2=False):
+  # !BOOT (an EXEC file) to play fnames in turn, then
+  # (if side2) wait for the last to finish and go to the
+  # !BOOT on the other side of a double-sided disk
+  data = "*BASIC\r"
+  if "BOOT_COPYRIGHT" in os.environ: data += "\rREM "+os.environ["BOOT_COPYRIGHT"]+"\r\r" # TODO: document this?
+  if len(fnames)==1: data += ('LOAD "%s"\rLIST\rRUN\r' % fnames[0])
+  else: data += "*CAT\r"+"REP.U.AD.-6=15:".join(('CH."%s"\r' % f) for f in fnames)
+  if side2: data += "REP.U.AD.-6=15\r*DR.2\r*EXEC !BOOT\r"
+  return data
+
+dfs_max_sectors = 800 # 80 tracks (can in theory go to 1023 sectors, but no real hardware would support it)
+def bbcPackDisks(datFiles):
+  # Splits datFiles among as few disk sides as we can
+  # (first-fit decreasing by sectors, with the !BOOT and
+  # the 30-file catalogue limit), keeping each side's files
+  # in their original order
+  sectors = [(len(bbcDfsProgram(d,b))+255)//256 for _,d,b in datFiles]
+  sides = [] # of [file indices, sectors used by files]
+  def fits(side,i):
+    if len(side[0]) == 30: return False
+    boot = bbcDfsBoot([datFiles[j][0] for j in side[0]+[i]],bbc_dsd) # (assume a side 2 follows, as the name lengths are what matter)
+    return 2+(len(boot)+255)//256+side[1]+sectors[i] <= dfs_max_sectors
+  for i in sorted(range(len(datFiles)),key=lambda i:-sectors[i]):
+    for side in sides:
+      if fits(side,i): break
+    else:
+      side = [[],0] ; sides.append(side)
+      assert fits(side,i), "%s is too big for a disk" % datFiles[i][0]
+    side[0].append(i) ; side[1] += sectors[i]
+  return [[datFiles[i] for i in sorted(s)] for s,_ in sides]
+
+def bbcDfsSide(datFiles,side2=False):
+  # Returns one side's catalogue and files, and how many
+  # sectors the side has
   opt4 = 3 # exec !BOOT
   disk_title = os.environ.get("DFS_TITLE","")
   disk_title += "\0"*max(0,12-len(disk_title))
   # catalogue is 31 items but we'll do !BOOT separately
   catNames,catInfo,catNo = ["\0"*8]*31,["\0"*8]*31,0
-  data = "*BASIC\r"
-  assert all(len(f)<=7 and re.match('^[A-Za-z0-9]*$',f) for f,_ in datFiles), "please keep DFS filenames to 7-char alphanumeric "+repr([f for f,_ in datFiles])
-  if "BOOT_COPYRIGHT" in os.environ: data += "\rREM "+os.environ["BOOT_COPYRIGHT"]+"\r\r" # TODO: document this?
-  if len(datFiles)==1: data += ('LOAD "%s"\rLIST\rRUN\r' % datFiles[0][0])
-  else: data += "*CAT\r"+"REP.U.AD.-6=15:".join(('CH."%s"\r' % f) for f,_ in datFiles)
-  catNames[0]="!BOOT  $"
-  catInfo[0]="".join([
-    "\0"*4, # !BOOT lsb-msb Load, lsb-msb Exec
-    chr(len(data)&0xFF)+chr(len(data)>>8), # !BOOT len
-    "\0", # no >64k options or high start-sector bits
-    "\2", # starts on sector 2
-    ])
-  data += "\0"*((256-(len(data)%256))&0xFF) # pad !BOOT
-  for fname,datBytes in datFiles:
-    catNo += 1; assert catNo<31,"Catalogue full"
-    lomem_set = "\xd2=\xb8P+"+str(len(datBytes)-1)
-    assert not acorn_electron, "make_bbcMicro_DFS_image is hard-coded to use the BBC Micro reader, not Electron"
-    datBytes="\r\x00\x00"+chr(len(lomem_set)+4)+lomem_set+"\r\x00\n@E%=\xb8P:\xe3C%=16\xb819:\xd4C%,0,0,0:\xed:N%=0:\xdec%(8):\xe3D%=0\xb88:c%(D%)=252:\xed\r\x00\x14\xe5\xf5:C%=0:\xf5:D%=?E%:E%=E%+1:c%(C%)=(D%\x8063)*4:I%=(D%\x8164)+1:C%=C%+I%:\xfdI%=4:D%=?E%:E%=E%+1:\xf5:\xfd\x96-6>3:\xe3I%=0\xb86\x883:S%=0:T%=0:\xe7c%(I%)=252:V%=0:\x8b\xe7c%(I%+1)=252:V%=1:\x8bS%=1:Q%=c%(I%+1)-c%(I%):\xe7c%(I%+2)=252:V%=2:\x8bR%=c%(I%+2)-c%(I%+1):T%=1:V%=3\r\x00\x1e'\xe7V%:V%=V%*24+55:N%=N%+1:\xe7N%=17:N%=1\r\x00(4\xe7V%:\xe2N%,3,0,Q%,R%,1,S%,T%,V%,0,0,-V%,V%,V%:V%=N%\r\x002$\xd4513+(I%\x813),V%,c%(I%),D%:\xed:\xfdD%=0\r\xff"+datBytes # This essentially tokenises the program with the 'abbreviated' version of the loop (and indirection instead of READ).  If changing it, the embedded binary line lengths will also need updating.
+  assert all(len(f)<=7 and re.match('^[A-Za-z0-9]*$',f) for f,_,_ in datFiles), "please keep DFS filenames to 7-char alphanumeric "+repr([f for f,_,_ in datFiles])
+  if datFiles:
+    data = bbcDfsBoot([f for f,_,_ in datFiles],side2)
+    catNames[0]="!BOOT  $"
+    catInfo[0]="".join([
+      "\0"*4, # !BOOT lsb-msb Load, lsb-msb Exec
+      chr(len(data)&0xFF)+chr(len(data)>>8), # !BOOT len
+      "\0", # no >64k options or high start-sector bits
+      "\2", # starts on sector 2
+      ])
+    data += "\0"*((256-(len(data)%256))&0xFF) # pad !BOOT
+    catNo = 1
+  else: data = "" # (blank side 2)
+  for fname,datBytes,bass in datFiles:
+    assert catNo<31,"Catalogue full"
+    datBytes = bbcDfsProgram(datBytes,bass)
     catNames[catNo]=fname+' '*(7-len(fname))+'$'
     catInfo[catNo] = "".join([
       "\0"*4, # lsb-msb Load, lsb-msb Exec (apparently not used for BASIC programs)
@@ -508,29 +1165,46 @@ def make_bbcMicro_DFS_image(datFiles):
     ])
     data += datBytes
     data += "\0"*((256-(len(data)%256))&0xFF) # pad
+    catNo += 1
   sectors = 2+len(data)/256
   if sectors<400: sectors=400 # 40 tracks
-  elif sectors<800: sectors=800 # 80 tracks
-  else: assert 0, "Disk image too full" # (can in theory go to 1023 sectors, but no real hardware would support it)
+  elif sectors<=dfs_max_sectors: sectors=dfs_max_sectors
+  else: assert 0, "Disk image too full"
   return "".join([
     disk_title[:8],
     "".join(catNames),
     disk_title[8:12],
     "\1", # disk cycle (BCD, incremented each time catalogue is written)
-    chr((1+catNo)*8),
+    chr(catNo*8),
     chr((sectors>>8)+16*opt4),
     chr(sectors&0xFF),
     "".join(catInfo),
-    data.rstrip("\0")])
+    data]),sectors
+
+def make_bbcMicro_DFS_image(datFiles):
+  return bbcDfsSide(datFiles)[0].rstrip("\0")
+
+def make_bbcMicro_DSD_image(side0,side2):
+  # A double-sided image has the sides' tracks interleaved
+  (side0,sectors),(side2,sectors2) = bbcDfsSide(side0,bool(side2)),bbcDfsSide(side2)
+  sectors = max(sectors,sectors2) ; track = 2560
+  side0 += "\0"*(sectors*256-len(side0)) ; side2 += "\0"*(sectors*256-len(side2))
+  return "".join(side0[i:i+track]+side2[i:i+track] for i in range(0,sectors*256,track)).rstrip("\0")
 if type("")==type(u""): # Python 3
   real_make_bbcMicro_DFS_image = make_bbcMicro_DFS_image
   def make_bbcMicro_DFS_image(datFiles):
     return real_make_bbcMicro_DFS_image(datFiles).encode('latin1')
+  real_make_bbcMicro_DSD_image = make_bbcMicro_DSD_image
+  def make_bbcMicro_DSD_image(side0,side2):
+    return real_make_bbcMicro_DSD_image(side0,side2).encode('latin1')
 
+bar_starts = None # microseconds at which each bar starts, if the MIDI file has time signatures (set per file, used by riscos_Maestro)
 dedup_microsec_quantise = 0 # for handling 'rolls' etc (currently used by bbc_micro, qbasic, grub; TODO: default 'beep' cmd also? but would need to interact with its variable pulse length)
+def dedup_sorted(noteNos): # (changes noteNos)
+  if force_monophonic and noteNos: return [max(noteNos)]
+  noteNos.sort() ; return noteNos
 def dedup_midi_note_chord(noteNos,microsecs):
-  if force_monophonic and noteNos: noteNos=[max(noteNos)]
-  else: noteNos.sort()
+  noteNos = dedup_sorted(noteNos)
   global dedup_chord,dedup_microsec
   if dedup_microsec_quantise and not microsecs==None:
     global dedup_microsec_error
@@ -548,20 +1222,156 @@ def dedup_midi_note_chord(noteNos,microsecs):
     add_midi_note_chord(dedup_chord,dedup_microsec)
     dedup_chord,dedup_microsec = noteNos,microsecs
 
+def dedup_timeline(timeline):
+  # Does the same as calling dedup_midi_note_chord on each
+  # (noteNos,microsecs) step of a whole timeline (the chords
+  # already put through dedup_sorted, and each list can be
+  # shared by several steps), but in one loop with the state
+  # in locals instead of a call per step.  As before, the
+  # last chord is left for the next flush.
+  global dedup_chord,dedup_microsec,dedup_microsec_error
+  cur,curLen,err = dedup_chord,dedup_microsec,dedup_microsec_error
+  quantise,perNote = dedup_microsec_quantise,(qbasic or grub)
+  steps = errTotal = 0 # (for --profile, which counts them after the loop)
+  for steps,(noteNos,microsecs) in enumerate(timeline,1):
+    if quantise:
+      microsecs += err ; oldM = microsecs
+      quantiseTo = quantise
+      if perNote and noteNos: quantiseTo *= len(noteNos)
+      microsecs = int((microsecs+quantiseTo/2)/quantiseTo) * quantiseTo
+      err = oldM - microsecs ; errTotal += abs(err)
+    if noteNos == cur and microsecs: curLen += microsecs
+    elif microsecs==0: continue # (a roll)
+    else:
+      add_midi_note_chord(cur,curLen)
+      cur,curLen = noteNos[:],microsecs
+  dedup_chord,dedup_microsec,dedup_microsec_error = cur,curLen,err
+  if profile:
+    profiler.counts["chords_in"] += steps
+    profiler.counts["quantise_error_us"] += errTotal
+
+# The chord cache stores the (noteNos,microsecs) calls that
+# dedup_midi_note_chord made to add_midi_note_chord.  Each is
+# a flags byte, a count byte, the notes (bytes if they're
+# integers up to 255, otherwise doubles) and the length
+# (a 64-bit integer or a double, whichever it was, because
+# Python 2's division depends on it).  They're preceded by
+# bar_starts (a count and doubles, or 0 if None) and by an
+# index for --start: a count, then for every so many seconds
+# of music, the time (as a double) and the offset of the
+# first call that starts at or after it.
+chord_cache_version = 4 # increase this if a change to the parser could change its chords
+chord_cache_seek_interval = 10000000 # microseconds between index entries
+def chordCacheFile(midiFile):
+  import hashlib
+  h = hashlib.sha1() ; f = open(midiFile,'rb')
+  while True:
+    b = f.read(65536)
+    if not b: break
+    h.update(b)
+  h.update(repr((chord_cache_version,sys.version_info[0],A,maxMicrosecs,force_monophonic,dedup_microsec_quantise,bool(qbasic or grub),bool(mac_voice))).encode('latin1'))
+  return os.path.join(chord_cache,h.hexdigest()+".chords")
+def readChordCache(fname,fromMicrosecs=0):
+  # Returns the chords from the last index entry at or
+  # before fromMicrosecs, the time that entry is at, and
+  # the bar starts
+  f = open(fname,'rb')
+  n = unpack('>L',f.read(4))[0]
+  bars = n and list(unpack('>%dd' % n,f.read(8*n))) or None
+  barBytes = 4+8*n
+  n = unpack('>L',f.read(4))[0] ; lo,hi = 0,n
+  t = i = 0 ; index = f.read(12*n)
+  while lo < hi: # binary search
+    mid = (lo+hi)//2
+    if unpack('>d',index[12*mid:12*mid+8])[0] <= fromMicrosecs: lo = mid+1
+    else: hi = mid
+  if lo:
+    t,i = unpack('>dL',index[12*lo-12:12*lo])
+    if t==int(t): t = int(t) # (as the lengths were, for Python 2)
+  f.seek(barBytes+4+12*n+i) ; data = f.read() ; i = 0 ; chords = []
+  while i < len(data):
+    flags,n = unpack('>BB',data[i:i+2]) ; i += 2
+    if flags & 1: notes = list(unpack('>%dd' % n,data[i:i+8*n])) ; i += 8*n
+    else:
+      notes = list(unpack('>%dB' % n,data[i:i+n])) ; i += n
+      if flags & 2: notes = list(map(float,notes))
+    if flags & 4: microsecs = unpack('>d',data[i:i+8])[0]
+    else: microsecs = unpack('>q',data[i:i+8])[0]
+    chords.append((notes,microsecs)) ; i += 8
+  f.close() ; os.utime(fname,None) # for least-recently-used
+  return chords,t,bars
+def writeChordCache(fname,chords,bars):
+  out,index = [],[] ; t = size = nextIndex = 0
+  for notes,microsecs in chords:
+    if t >= nextIndex:
+      index.append(pack('>dL',t,size))
+      nextIndex = (t//chord_cache_seek_interval+1)*chord_cache_seek_interval
+    t += microsecs
+    flags = 4*(type(microsecs)==float)
+    for n in notes:
+      if not (n==int(n) and 0<=n<256): flags |= 1
+      elif type(n)==float: flags |= 2
+    if flags & 1: r = pack('>BB%dd' % len(notes),flags,len(notes),*notes)
+    else: r = pack('>BB%dB' % len(notes),flags,len(notes),*map(int,notes))
+    r += pack(flags & 4 and '>d' or '>q',microsecs)
+    out.append(r) ; size += len(r)
+  if not os.path.isdir(chord_cache): os.makedirs(chord_cache)
+  tmp = fname+".%d" % os.getpid() # (in case of --jobs)
+  bars = bars or []
+  open(tmp,'wb').write(pack('>L%dd' % len(bars),len(bars),*bars)+pack('>L',len(index))+b"".join(index+out)) ; os.rename(tmp,fname)
+  # and evict least recently used beyond the size limit:
+  entries = [] ; total = 0
+  for f in os.listdir(chord_cache):
+    if f.endswith(".chords"):
+      st = os.stat(os.path.join(chord_cache,f))
+      entries.append((st.st_mtime,st.st_size,f)) ; total += st.st_size
+  entries.sort()
+  while entries and total > chord_cache_size*1048576:
+    _,size,f = entries.pop(0) ; total -= size
+    try: os.remove(os.path.join(chord_cache,f))
+    except OSError: pass # another process got there first
+
 A=440 # you can change this if you want to re-pitch
-midi_note_to_freq = []
-import math,re
-for i in range(128): midi_note_to_freq.append((A/32.0)*math.pow(2,(len(midi_note_to_freq)-9)/12.0))
-assert midi_note_to_freq[69] == A # (comment this out if using floating-point tuning because it might fail due to rounding)
+midi_note_to_freq = [] # (made by setup() from A)
+import math,re,itertools
 def to_freq(n):
   if n==int(n): return midi_note_to_freq[int(n)]
   else: return (A/32.0)*math.pow(2,(n-9)/12.0)
 
 # Begin RISC OS Maestro code
 
-Maestro_header = 'Maestro\x0a\x02'
+maestro_bars = [64] # bar lengths in hemidemisemiquavers (the last is repeated); 4/4 unless maestroBars() finds time signatures
 
-def BASIC_int(n): return chr(0x40)+chr(n>>24)+chr((n>>16)&0xFF)+chr((n>>8)&0xFF)+chr(n&0xFF)
+def maestroBars():
+    # bar_starts in hemis at the current tempo (so the bars
+    # of a piece with time signatures get their notes split
+    # and barlines put where the piece has them)
+    if not bar_starts: return [64]
+    h = [int(t/hemi_microsecs) for t in bar_starts] # (as MaestroMidiNote.quantTo)
+    bars = [b-a for a,b in zip(h,h[1:]) if b>a] # (ignoring any that round to nothing)
+    return bars or [64]
+def maestroBarLength(bar): return maestro_bars[min(bar,len(maestro_bars)-1)]
+
+def maestroReset():
+    global current_chord,current_time,riscos_channels
+    global maestro_moved,maestro_notes,maestro_dropped
+    current_chord = [] ; current_time = 0 ; riscos_channels = [[],[],[],[],[],[],[],[]]
+    maestro_moved = maestro_notes = 0 ; maestro_dropped = [] # for --maestro-bpm auto
+
+def maestroTry(bpm):
+    # Encodes the chords kept by --maestro-bpm auto at that
+    # tempo.  Returns the data, the tempo, how far notes were
+    # moved on average (in microseconds) and the dropped notes.
+    global default_bpm,hemi_microsecs
+    default_bpm,hemi_microsecs = bpm,int(3750000/bpm)
+    maestroReset()
+    for noteNos,microsecs in maestro_chords: maestroAdd(noteNos,microsecs)
+    return maestroEncode(),bpm,maestro_moved/2.0/max(1,maestro_notes),maestro_dropped
+
+# (blocks etc are bytearrays, so long pieces aren't quadratic)
+Maestro_header = bytearray(b'Maestro\x0a\x02')
+
+def BASIC_int(n): return bytearray((0x40,n>>24,(n>>16)&0xFF,(n>>8)&0xFF,n&0xFF))
 
 class MaestroMidiNote:
     def __init__(self,noteNo,startTime):
@@ -572,7 +1382,8 @@ class MaestroMidiNote:
         self.startTime = int(self.startTime/resolution) * resolution
         self.endTime = int(self.endTime/resolution) * resolution
         if self.endTime == self.startTime: self.endTime += resolution # try to avoid quantising it out completely
-    def lenAndDotsList(self,hemiLen,barHemisLeft): # could be several notes tied
+    def lenAndDotsList(self,hemiLen,bar): # could be several notes tied (bar is updated)
+        barHemisLeft = bar[1]
         hemisLeft = int(self.timeLen()/hemiLen)
         lTry,lH = 1,64 ; ret = []
         while hemisLeft:
@@ -582,26 +1393,30 @@ class MaestroMidiNote:
                     dots += 1 ; lHT += dotVal ; dotVal = int(dotVal/2)
                 hemisLeft -= lHT ; barHemisLeft -= lHT ; ret.append((lTry,dots))
                 if not barHemisLeft:
-                    barHemisLeft = 64 # TODO: assumes 4/4
+                    bar[0] += 1 ; barHemisLeft = maestroBarLength(bar[0])
                     lTry,lH =1,64 ; continue
             lTry <<= 1 ; lH >>= 1
             assert not (lH==0 and hemisLeft)
-        return ret,barHemisLeft
-    def note(self,hemiLen,timeCountFrom,barHemisLeft):
+        bar[1] = barHemisLeft
+        return ret
+    def note(self,hemiLen,timeCountFrom,bar,out): # appends to bytearray out
         assert timeCountFrom <= self.startTime
-        ret = []
         if timeCountFrom < self.startTime:
             oet,self.endTime,self.startTime = self.endTime,self.startTime,timeCountFrom
-            ldl,barHemisLeft = self.lenAndDotsList(hemiLen,barHemisLeft)
-            for length,dots in ldl: ret.append(note(None,length,dots))
+            ldl = self.lenAndDotsList(hemiLen,bar)
+            for length,dots in ldl: out += note(None,length,dots)
             self.startTime,self.endTime = self.endTime,oet
-        ldl,barHemisLeft = self.lenAndDotsList(hemiLen,barHemisLeft)
-        if not ldl: return "".join(ret),barHemisLeft # note must have been completely quantised out
-        for length,dots in ldl[:-1]: ret.append(note(self.noteNo,length,dots,tieWithNext=True))
-        ret.append(note(self.noteNo,ldl[-1][0],ldl[-1][1]))
-        return "".join(ret),barHemisLeft
+        ldl = self.lenAndDotsList(hemiLen,bar)
+        if not ldl: return # note must have been completely quantised out
+        for length,dots in ldl[:-1]: out += note(self.noteNo,length,dots,tieWithNext=True)
+        out += note(self.noteNo,ldl[-1][0],ldl[-1][1])
 
+noteCache = {}
 def note(midiNote,length=4,dots=0,clef="treble",stemDown=None,tieWithNext=False,beamWithNext=False):
+    k = (midiNote,length,dots,clef,stemDown,tieWithNext,beamWithNext)
+    if not k in noteCache: noteCache[k] = bytes(note_uncached(*k))
+    return noteCache[k]
+def note_uncached(midiNote,length,dots,clef,stemDown,tieWithNext,beamWithNext):
     if not midiNote==None: # midiNote=None for a rest
         def f(mn):
             m = mn % 12
@@ -627,10 +1442,10 @@ def note(midiNote,length=4,dots=0,clef="treble",stemDown=None,tieWithNext=False,
     assert 0 <= dots <= 3 ; r2 += dots*8
     if sharp: r2 += 2
     else: r2 += 1 # natural (TODO: figure out if actually needed and omit if not)
-    return chr(r) + chr(r2)
+    return bytearray((r,r2))
 
 def playLen(secondNoterestByte): # for gate-byte sync
-    if type(secondNoterestByte)==str:
+    if not type(secondNoterestByte)==int:
         secondNoterestByte = ord(secondNoterestByte)
     numDots = (secondNoterestByte >> 3) & 3
     secondNoterestByte = int(secondNoterestByte/32)
@@ -640,63 +1455,68 @@ def playLen(secondNoterestByte): # for gate-byte sync
     for i in range(numDots):
       l += dotVal ; dotVal = int(dotVal/2)
     return l
+playLens = [playLen(b) for b in range(256)]
+assert min(playLens) > 0
 
 def gatesBytes(notesRestQueues):
     assert len(notesRestQueues) == 8
-    lenLeft = [0]*8 ; nrq = notesRestQueues[:] ; r = [] ; barLeft = 64*8
-    while any(nrq):
+    lenLeft = [0]*8 ; nrq = [bytearray(q) for q in notesRestQueues] ; r = bytearray() ; bar = 0 ; barLeft = maestroBarLength(0)*8
+    pos = [0]*8 # (a cursor into each queue: slicing would be quadratic)
+    ends = [len(q) for q in nrq] ; unfinished = len([e for e in ends if e])
+    lens,channels = playLens,range(8)
+    while unfinished:
         b = 0 ; toSub = 0
-        for i in range(8):
-            if nrq[i] and not lenLeft[i]:
+        for i in channels:
+            l = lenLeft[i]
+            if not l and pos[i] < ends[i]:
                 b |= (1 << i)
-                lenLeft[i] = playLen(nrq[i][1])
-                assert lenLeft[i] > 0, lenLeft[i]
-                nrq[i] = nrq[i][2:]
-            if lenLeft[i] and (not toSub or lenLeft[i]<toSub): toSub=lenLeft[i]
-        if b: r.append(chr(b))
+                p = pos[i] ; l = lenLeft[i] = lens[nrq[i][p+1]] # (all > 0)
+                pos[i] = p = p+2
+                if p >= ends[i]: unfinished -= 1
+            if l and (not toSub or l<toSub): toSub=l
+        if b: r.append(b)
         assert toSub > 0
-        for i in range(8):
-            if lenLeft[i]: lenLeft[i] -= toSub
-        assert 0 in lenLeft
+        lenLeft = [l and l-toSub for l in lenLeft] # (at least one is now 0)
         barLeft -= toSub
         assert barLeft >= 0
         if not barLeft:
-            r.append(chr(0)+chr(32)) # barline (needed for reliable playing)
-            barLeft = 64*8
-    return "".join(r) # (gatesBytes can also include 0 followed by time signature codes etc)
+            r += b'\x00\x20' # barline (needed for reliable playing)
+            bar += 1 ; barLeft = maestroBarLength(bar)*8
+    return r # (gatesBytes can also include 0 followed by time signature codes etc)
 
 # blocks in any order:
 
-def musicData_block(notesRestQueues): # each queue is a string of 2-byte returns from note() above
+def musicData_block(notesRestQueues): # each queue is a bytearray of 2-byte returns from note() above
     assert len(notesRestQueues) <= 8
-    while len(notesRestQueues) < 8: notesRestQueues.append("")
+    while len(notesRestQueues) < 8: notesRestQueues.append(bytearray())
     gb = gatesBytes(notesRestQueues)
     l = [gb]+notesRestQueues
-    r = []
-    for i in l: r.append(BASIC_int(len(i)))
-    return chr(1)+''.join(r)+''.join(l)
+    r = bytearray((1,))
+    for i in l: r += BASIC_int(len(i))
+    for i in l: r += i
+    return r
 
 def setStaves_block(numStaves=1,numPercStaves=1):
     assert 1 <= numStaves <= 4 and 0 <= numPercStaves <= 1
-    return chr(2)+chr(numStaves-1)+chr(numPercStaves-1)
+    return bytearray((2,numStaves-1,numPercStaves-1))
 
 def setInstruments_block(voiceNumberList=[1]*8): # voice 5 is probably the perceptual loudest, might be useful if using unpowered speakers on a RISC OS Raspberry Pi; voice 1 (default) sounds more gentle though (but still better include it or the volume block might not be interpreted)
     assert len(voiceNumberList) == 8
-    r = []
-    for i in range(8): r.append(chr(i)+chr(voiceNumberList[i]))
-    return chr(3)+''.join(r)
+    r = bytearray((3,))
+    for i in range(8): r += bytearray((i,voiceNumberList[i]))
+    return r
 
 def setVolumes_block(volumesList=[7]*8):
     assert len(volumesList)==8
     for x in volumesList: assert 0<=x<=7
-    return chr(4)+''.join(map(chr,volumesList))
+    return bytearray([4]+volumesList)
 
 def setPans_block(stereoPosList):
     assert len(stereoPosList)==8
     for x in stereoPosList: assert -3<=x<=3
-    return chr(5)+''.join(map(lambda x:chr(x+3),stereoPosList))
+    return bytearray([5]+[x+3 for x in stereoPosList])
 
-def setBPM_block(bpm): return chr(6)+chr(allowed_BPMs.index(bpm))
+def setBPM_block(bpm): return bytearray((6,allowed_BPMs.index(bpm)))
 
 # End RISC OS Maestro code
 
@@ -705,41 +1525,72 @@ def setBPM_block(bpm): return chr(6)+chr(allowed_BPMs.index(bpm))
 # with much cutting-down and modifying
 def toBytes(value):
     return unpack('%sB' % len(value), value)
-maxMicrosecs = float(os.environ.get("maxTime",maxTime))*1e6
 class MidiToBeep:
+    defaultMicrosecsPerDivision = 10000 # (before any tempo)
     def update_time(self,divisions=0,relative=1):
         oldDivs = self.divisionCount
         if relative: self.divisionCount += divisions
         else: self.divisionCount = divisions
-        newMicrosecs = self.microsecs + (self.divisionCount-oldDivs)*self.microsecsPerDivision
+        if self.tempoFrom <= oldDivs < self.tempoEnd and self.divisionCount <= self.tempoEnd: newMicrosecs = self.microsecs + (self.divisionCount-oldDivs)*self.microsecsPerDivision
+        else: newMicrosecs = self.microsecs + self.mapMicrosecs(oldDivs,self.divisionCount)
         if maxMicrosecs: newMicrosecs = min(newMicrosecs, maxMicrosecs)
         microsecsSeen = newMicrosecs - self.microsecs
         self.microsecs = newMicrosecs
         if microsecsSeen:
             # time was advanced, so output something
-            d = {}
-            for c,v in self.current_notes_on: d[v+self.semitonesAdd[c]]=1
-            if self.need_to_interleave_tracks: self.tracks[-1].append([d.keys(),microsecsSeen])
-            else: dedup_midi_note_chord(list(d.keys()),microsecsSeen)
+            if self.chord == None:
+                d = {}
+                for c,v in self.current_notes_on: d[v+self.semitonesAdd[c]]=1
+                self.chord,self.chordNo = list(d.keys()),None
+            if self.need_to_interleave_tracks: self.add_to_timeline(microsecsSeen)
+            elif self.steps != None:
+                if self.chordNo == None: self.chordNo = dedup_sorted(self.chord[:])
+                self.steps.append(self.chordNo) ; self.stepLengths.append(microsecsSeen)
+            else: dedup_midi_note_chord(self.chord[:],microsecsSeen)
+    def add_to_timeline(self,microsecs):
+        # Format 1 tracks are stored as columns until eof():
+        # each step's length, and the number of its chord in a
+        # pool shared by all tracks (a chord is added to the pool
+        # only when the notes change).
+        if self.chordNo == None:
+            self.chordNotes.extend(self.chord)
+            self.chordStarts.append(len(self.chordNotes))
+            self.chordNo = len(self.chordStarts)-2
+        self.trackChords[-1].append(self.chordNo)
+        lengths = self.trackLengths[-1]
+        if lengths == None: lengths = self.trackLengths[-1] = array(type(microsecs)==float and 'd' or 'l')
+        elif type(lengths)==array and (type(microsecs)==float) != (lengths.typecode=='d'):
+            lengths = self.trackLengths[-1] = list(lengths) # mixed ints and floats: keep them as they are (it matters to Python 2's division)
+        lengths.append(microsecs)
     def reset_time(self):
+        self.endTick = max(self.endTick, self.divisionCount)
         self.divisionCount = self.microsecs = 0
     def set_current_track(self, new_track): self._current_track = new_track
     def __init__(self):
         self.divisionCount = self.microsecs = 0
         self._current_track = 0
         self._running_status = None
-        self.current_notes_on = []
+        self.current_notes_on = {} # (channel,note) -> number of times it's on
+        self.chord = None # cached from current_notes_on
         self.rpn100 = [0]*16
         self.rpn101 = [0]*16
         self.semitoneRange = [1]*16
         self.semitonesAdd = [0]*16
-        self.microsecsPerDivision = 10000
+        self.microsecsPerDivision = self.defaultMicrosecsPerDivision
+        self.tempoTicks = None
+        self.tempoFrom,self.tempoEnd = 0,1<<62 # where microsecsPerDivision applies
+        self.tempos,self.timeSigs,self.endTick = [],[],0 # for bar_starts
     def note_on(self,channel,note):
-        if not channel==9: self.current_notes_on.append((channel,note))
+        if not channel==9:
+            self.current_notes_on[(channel,note)] = self.current_notes_on.get((channel,note),0) + 1
+            self.chord = None
         if mac_voice: dedup_midi_note_chord([],None) # repeated notes must be re-struck on that o/p
     def note_off(self,channel,note):
-        try: self.current_notes_on.remove((channel,note))
-        except ValueError: pass
+        n = self.current_notes_on.get((channel,note),0)
+        if n==1:
+            del self.current_notes_on[(channel,note)]
+            self.chord = None
+        elif n: self.current_notes_on[(channel,note)] = n-1
     def continuous_controller(self, channel, controller, value):
         # Interpret "pitch bend range":
         if controller==100: self.rpn100[channel] = value
@@ -750,33 +1601,112 @@ class MidiToBeep:
         # Pitch bend is sometimes used for slurs
         # so we'd better interpret it (only MSB for now; full range is over 8192)
         self.semitonesAdd[channel] = (value-64)*self.semitoneRange[channel]/64.0
+        self.chord = None
     def header(self, format=0, nTracks=1, division=96):
         self.division=division
         self.need_to_interleave_tracks = (format==1)
-        self.tracks = [[]][:]
+        self.trackLengths,self.trackChords = [],[]
+        self.chordNotes,self.chordStarts = array('d'),array('L',[0])
+        if dedup_microsec_quantise and not self.need_to_interleave_tracks: self.steps,self.stepLengths = [],[] # format 0 is batched too if it's quantised (chordNo is then its sorted chord)
+        else: self.steps = None
     def eof(self):
+        global bar_starts
         if self.need_to_interleave_tracks:
-            while True: # delete empty tracks
-                try: self.tracks.remove([])
-                except ValueError: break
-            while self.tracks:
-                minLen = min([t[0][1] for t in self.tracks])
-                d = {}
-                for t in self.tracks: d.update([(n,1) for n in t[0][0]])
-                dedup_midi_note_chord(list(d.keys()),minLen)
-                for t in self.tracks:
-                    t[0][1] -= minLen
-                    if t[0][1]==0: del t[0]
-                while True: # delete empty tracks
-                    try: self.tracks.remove([])
-                    except ValueError: break
+            # Each step sounds the union of all tracks' current
+            # chords for as long as the shortest of them.  Moving
+            # a cursor along each track, and rebuilding the list
+            # of tracks only when one runs out, keeps this linear
+            # in the number of events.  (The remaining lengths are
+            # still reduced by subtraction, not compared as
+            # absolute times on a heap, so that the floating-point
+            # rounding, and hence the output, is exactly as before.)
+            notes,starts = self.chordNotes,self.chordStarts
+            def chordAt(t):
+                c = t[3][t[1]]
+                return notes[starts[c]:starts[c+1]]
+            tracks = [] # [length left, cursor, lengths, chord numbers, current chord]
+            for lengths,chords in zip(self.trackLengths,self.trackChords):
+                if chords:
+                    t = [lengths[0],0,lengths,chords]
+                    tracks.append(t+[chordAt(t)])
+            def timeline(tracks):
+                while tracks:
+                    minLen = min([t[0] for t in tracks])
+                    d = {}
+                    for t in tracks:
+                        for n in t[4]: d[n]=1
+                    yield dedup_sorted(list(d.keys())),minLen
+                    finished = False
+                    for t in tracks:
+                        t[0] -= minLen
+                        if t[0]==0:
+                            t[1] += 1
+                            if t[1]==len(t[3]): finished = True
+                            else: t[0],t[4] = t[2][t[1]],chordAt(t)
+                    if finished: tracks = [t for t in tracks if t[1]<len(t[3])]
+            dedup_timeline(timeline(tracks))
+        elif self.steps != None: dedup_timeline(zip(self.steps,self.stepLengths))
+        if self.timeSigs: bar_starts = self.barStarts()
     def start_of_track(self, n_track=0):
         self.reset_time()
         self._current_track += 1
-        if self.need_to_interleave_tracks: self.tracks.append([])
+        if self.need_to_interleave_tracks:
+            self.trackLengths.append(None) # (array type is chosen on first use)
+            self.trackChords.append(array('L'))
     def tempo(self, value):
-        # TODO if need_to_interleave_tracks, and tempo is not already put in on all tracks, and there's a tempo command that's not at the start and/or not on 1st track, we may need to do something
+        if self.tempoTicks: return # (format 1: using the map)
         self.microsecsPerDivision = value*1.0/self.division
+        self.tempos.append((self.divisionCount,value)) # (for barStarts)
+    def time_signature(self, numerator, denomPower):
+        # bar length in ticks from here (the denominator is
+        # given as a power of 2)
+        self.timeSigs.append((self.divisionCount,numerator*4.0*self.division/(1<<denomPower)))
+    def tempo_map(self, tempos):
+        # Format 1 files keep their tempo changes in the first
+        # track, but they apply to all tracks, so the parser
+        # gives them to us before the first track (as a list
+        # of (tick,tempo)).  We keep the tick each tempo starts
+        # at and the microseconds up to there, for bisecting.
+        # (Without any, tempo() works as for format 0.)
+        if not tempos: return
+        self.tempoTicks,self.tempoMpd,self.tempoStart = self.tempoLists(tempos)
+        self.tempoEnd = 0 # (look it up next time)
+    def tempoLists(self, tempos):
+        ticks,mpd,start = [0],[self.defaultMicrosecsPerDivision],[0]
+        for tick,value in tempos:
+            if not tick==ticks[-1]:
+                start.append(start[-1]+(tick-ticks[-1])*mpd[-1])
+                ticks.append(tick) ; mpd.append(None)
+            mpd[-1] = value*1.0/self.division
+        return ticks,mpd,start
+    def barStarts(self):
+        # The microseconds at which each bar starts, up to the
+        # end of the last one, from the time signatures (a new
+        # one part-way through a bar starts another bar, as
+        # after an anacrusis).  Before the first it's 4/4.
+        if self.tempoTicks: ticks,mpd,start = self.tempoTicks,self.tempoMpd,self.tempoStart
+        else: ticks,mpd,start = self.tempoLists(sorted(self.tempos,key=lambda t:t[0]))
+        sigs = sorted(self.timeSigs,key=lambda s:s[0]) # (stable, so a later one at the same tick wins)
+        end = max(self.endTick, self.divisionCount)
+        bars,tick,barTicks,i = [],0,4.0*self.division,0
+        while True:
+            while i < len(sigs) and sigs[i][0] <= tick:
+                barTicks = sigs[i][1] ; i += 1
+            j = bisect_right(ticks,tick)-1
+            bars.append(start[j]+(tick-ticks[j])*mpd[j])
+            if tick >= end: return bars
+            tick += barTicks
+            if i < len(sigs) and sigs[i][0] < tick: tick = sigs[i][0]
+    def mapMicrosecs(self,fromDiv,toDiv):
+        # when update_time moves out of the current tempo
+        ticks,mpd = self.tempoTicks,self.tempoMpd
+        i = bisect_right(ticks,fromDiv)-1
+        self.tempoFrom,self.tempoEnd = ticks[i],(ticks[i+1:] or [1<<62])[0]
+        self.microsecsPerDivision = mpd[i]
+        if toDiv <= self.tempoEnd: return (toDiv-fromDiv)*mpd[i] # (as for format 0)
+        j = bisect_right(ticks,toDiv)-1
+        start = self.tempoStart
+        return start[j]+(toDiv-ticks[j])*mpd[j] - start[i]-(fromDiv-ticks[i])*mpd[i]
 
 class RawInstreamFile:
     def __init__(self, infile):
@@ -802,6 +1732,39 @@ class RawInstreamFile:
             var = (var << 7) + (byte & 0x7F)
             if not 0x80 & byte: break
         return var
+try:
+    import mmap
+    from struct import Struct
+except ImportError: mmap = None # (just use RawInstreamFile)
+if mmap:
+  bytesAreInts = (type(b"x"[0])==int) # Python 3 (mmap indexes like bytes)
+  class MappedInstreamFile(RawInstreamFile):
+    # Same interface as RawInstreamFile, but maps the file
+    # rather than reading it all in, and decodes numbers in
+    # place instead of slicing them out first.
+    bew = {1:Struct('>B'), 2:Struct('>H'), 4:Struct('>L')}
+    def __init__(self, infile):
+        self.f = open(infile, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.data)
+        self.cursor = 0
+    def readBew(self, n_bytes=1, move_cursor=1):
+        c = self.cursor
+        if c+n_bytes > self.size: return RawInstreamFile.readBew(self, n_bytes, move_cursor) # short read at end of file: do what we always did
+        if n_bytes==1 and bytesAreInts: value = self.data[c]
+        else: value = self.bew[n_bytes].unpack_from(self.data, c)[0]
+        if move_cursor: self.cursor = c+n_bytes
+        return value
+    def readVarLen(self):
+        data, var = self.data, 0
+        c = self.cursor ; end = min(c+4, self.size)
+        while c < end:
+            byte = data[c] ; c += 1
+            if not bytesAreInts: byte = ord(byte)
+            var = (var << 7) + (byte & 0x7F)
+            if not 0x80 & byte: break
+        self.cursor = c
+        return var
 class EventDispatcher:
     def __init__(self, outstream):
         self.outstream = outstream
@@ -831,11 +1794,16 @@ class EventDispatcher:
             stream.continuous_controller(channel, controller, value)
         elif high_nibble == 0xE0: # pitch bend
             stream.pitch_bend(channel, data[1])
+    def tempo_map(self, tempos):
+        self.outstream.tempo_map(tempos)
     def meta_events(self, meta_type, data):
         stream = self.outstream
         if meta_type == 0x51: # tempo
             b1, b2, b3 = toBytes(data)
             stream.tempo((b1<<16) + (b2<<8) + b3)
+        elif meta_type == 0x58 and len(data) >= 2: # time signature
+            nn, dd = toBytes(data[:2])
+            if nn and dd <= 6: stream.time_signature(nn, dd) # (up to /64, as Maestro can't go shorter)
 class MidiFileParser:
     def __init__(self, raw_in, outstream):
         self.raw_in = raw_in
@@ -888,14 +1856,46 @@ class MidiFileParser:
                 channel_data = raw_in.nextSlice(data_size)
                 event_type, channel = high_nibble, low_nibble
                 dispatch.channel_messages(event_type, channel, channel_data)
+    def scanTempos(self):
+        # Returns the (tick,tempo) changes in the track at the
+        # cursor, without dispatching anything or moving on
+        raw_in = self.raw_in ; start = raw_in.getCursor()
+        raw_in.moveCursor(4)
+        track_endposition = raw_in.readBew(4)
+        track_endposition += raw_in.getCursor()
+        tick,status,tempos = 0,None,[]
+        while raw_in.getCursor() < track_endposition:
+            tick += raw_in.readVarLen()
+            if raw_in.readBew(move_cursor=0) & 0x80: status = raw_in.readBew()
+            if status == 0xFF:
+                meta_type = raw_in.readBew()
+                meta_data = raw_in.nextSlice(raw_in.readVarLen())
+                if meta_type == 0x51 and len(meta_data)==3:
+                    b1, b2, b3 = toBytes(meta_data)
+                    tempos.append((tick,(b1<<16) + (b2<<8) + b3))
+            elif status == 0xF0:
+                raw_in.nextSlice(raw_in.readVarLen()-1)
+                if raw_in.readBew(move_cursor=0) == 0xF7:
+                    raw_in.readBew()
+            elif status & 0xF0 == 0xF0: raw_in.nextSlice({ 0xF1:1, 0xF2:2, 0xF3:1 }.get(status, 0))
+            elif status & 0xE0 == 0xC0: raw_in.moveCursor(1) # 0xC0 or 0xD0
+            else: raw_in.moveCursor(2)
+        raw_in.moveCursor(start-raw_in.getCursor())
+        return tempos
     def parseMTrkChunks(self):
+        if self.format == 1 and self.nTracks > 1:
+            self.dispatch.tempo_map(self.scanTempos())
         for t in range(self.nTracks):
             self._current_track = t
             self.parseMTrkChunk()
         self.dispatch.eof()
 class MidiInFile:
     def __init__(self, outStream, infile):
-        self.raw_in = RawInstreamFile(infile)
+        self.raw_in = None
+        if mmap:
+            try: self.raw_in = MappedInstreamFile(infile)
+            except (ValueError, EnvironmentError): pass # e.g. empty file or a pipe: fall back to reading it in
+        if not self.raw_in: self.raw_in = RawInstreamFile(infile)
         self.parser = MidiFileParser(self.raw_in, outStream)
     def read(self):
         p = self.parser
@@ -913,32 +1913,64 @@ except: # Python 2.3 (e.g. on RISC OS 4)
       if not i: return False
     return True
 
-if delArg('--version'): print(__doc__),sys.exit(0)
-helpText = __doc__+"\nSyntax: python midi-beeper.py [options] MIDI-filename ...\nOptions: --bbc | --electron | --bbc-binary | --bbc-ssd | --bbc-sdl | --maestro | --grub | --qbasic | --Organ | --Joelle (--praat --json)\n"
-if len(sys.argv)<2: sys.stderr.write(helpText),sys.exit(1)
-elif delArg('--help'): print(helpText),sys.exit(0)
-if acorn_electron: name = "MIDI to Acorn Electron"
-elif (bbc_micro or bbc_micro==[]): name = "MIDI to BBC Micro"
-elif riscos_Maestro: name = "MIDI to Maestro"
-else: name = "MIDI Beeper"
-sys.stderr.write(name+__doc__[__doc__.index(" v"):])
 try: xrange
 except: xrange = range # Python 3
-for midiFile in sys.argv[1:]:
+helpText = __doc__+"\nSyntax: python midi-beeper.py [options] MIDI-filename ...\nOptions: --bbc | --electron | --bbc-binary | --bbc-ssd | --bbc-sdl | --maestro | --grub | --qbasic | --Organ | --Joelle (--praat --json --rate N --osc square|wavetable --buffer N --jobs N --maestro-bpm N|auto --maestro-tolerance MS --bbc-noise-bass on|off|auto --serve PORT|SOCKET --start SECONDS --direct --drift --profile --profile-json)\n"
+
+def convert(midiFile):
+    # Per-file work.  With --jobs this runs in a worker
+    # process, so it returns anything the main process needs
+    # (the BBC program and whether it has a noise-channel
+    # bass, for --bbc-ssd) rather than keeping it.
+    global dedup_chord,dedup_microsec,dedup_microsec_error,bbc_micro
+    global bbc_bass
+    global add_midi_note_chord,bar_starts
+    if profile: profiler.begin(midiFile)
     init() ; dedup_chord,dedup_microsec = [],0
-    dedup_microsec_error = 0
-    sys.stderr.write("Parsing MIDI file "+midiFile+"\n")
-    MidiInFile(MidiToBeep(), midiFile).read()
-    dedup_midi_note_chord([],None) # ensure flushed
+    dedup_microsec_error = 0 ; bar_starts = None
+    cacheFile = None
+    if chord_cache: cacheFile = chordCacheFile(midiFile)
+    if start_time:
+      start = int(start_time*1e6) ; played = [0]
+      playing_add = add_midi_note_chord
+      def add_midi_note_chord(noteNos,microsecs):
+        t = played[0] ; played[0] = t+microsecs
+        if t < start:
+          if t+microsecs <= start: return
+          microsecs -= start-t # (the chord sounding at --start)
+        playing_add(noteNos,microsecs)
+    if cacheFile and os.path.exists(cacheFile):
+      sys.stderr.write("Using cached chords for "+midiFile+"\n")
+      chords,t,bar_starts = readChordCache(cacheFile,start_time*1e6)
+      if start_time: played[0] = t
+      for noteNos,microsecs in chords: add_midi_note_chord(noteNos,microsecs)
+    else:
+      if cacheFile:
+        chords,real_add_midi_note_chord = [],add_midi_note_chord
+        def add_midi_note_chord(noteNos,microsecs):
+          chords.append((noteNos[:],microsecs)) # (before the backend changes noteNos)
+          real_add_midi_note_chord(noteNos,microsecs)
+      sys.stderr.write("Parsing MIDI file "+midiFile+"\n")
+      MidiInFile(MidiToBeep(), midiFile).read()
+      dedup_midi_note_chord([],None) # ensure flushed
+      if cacheFile:
+        add_midi_note_chord = real_add_midi_note_chord
+        writeChordCache(cacheFile,chords,bar_starts)
+    if start_time:
+      add_midi_note_chord = playing_add
+      if bar_starts: bar_starts = [0]+[b-start for b in bar_starts if b > start] # (the first is an anacrusis)
+    if bbc_micro or bbc_micro==[]: bbcFlush()
+    if profile: profiler.parsed()
     if bbc_micro or bbc_micro==[]:
       if bbc_ssd:
-        bbcFile = midiFile.replace(os.extsep+"midi","").replace(os.extsep+"mid","")
-        if os.sep in bbcFile: bbcFile=bbcFile[bbcFile.rindex(os.sep)+1:]
-        if not 0<len(bbcFile)<=7: bbcFile="TUNE%d" % (1+len(bbc_files))
-        bbc_files.append((bbcFile,"".join(chr(x) for x in (bbc_micro+[255,0]))))
+        bbcData = "".join(chr(x) for x in (bbcRepeats(bbc_micro)+[255,0]))
+        bass = bbc_bass
         # and reset:
-        bbc_micro = []
+        bbc_micro,bbc_bass = [],None
         for i in xrange(len(current_array)): current_array[i]=63
+        for k in bbc_prepass: bbc_prepass[k] = 0
+        if profile: profiler.end()
+        return bbcData,bass
       # else (BBC non-SSD) we'll end below (TODO: per-file?)
     elif riscos_Maestro:
         add_midi_note_chord([],0)
@@ -960,72 +1992,329 @@ for midiFile in sys.argv[1:]:
     elif voice_json: print("]}")
     elif not aplay and not grub:
         sys.stderr.write("Playing "+midiFile+"\n")
-        runBeep(" ".join(cumulative_params))
-if bbc_ssd and bbc_files:
-  ssdFile=os.environ.get("DFS_TITLE","tunes")+".ssd"
-  sys.stderr.write("Writing output to %s\n" % ssdFile)
-  open(ssdFile,"wb").write(make_bbcMicro_DFS_image(bbc_files))
-elif bbc_micro:
-    if bbc_binary: # need to get it in via indirection
-      bbc_micro += [255,0]
-# :EQUD&12345678 - 14 keystrokes for 4 bytes
-# + 7 for every 60 bytes, total = 14/4+7/60
-      if len(bbc_micro) >= 15000: sys.stderr.write("This might exceed BeebEm's 32K keystroke limit. Try pasting 150 lines at a time.\n") # TODO: could check the *exact* limit, but would have to count the code at the start etc
-      use_input_loop = ( 8000 < len(bbc_micro) < 15000 ) # saves keystrokes, but might not save actual typing time in a museum etc because EQUD can be copied and the EQUD version is more 'chunked' and easier to track; might be useful to get around max-keystroke limitations on emulators IF we're not exceeding them anyway: typical limit 32k keystrokes which is about 9000 bytes via EQUD method and 16000 via input loop, but allow for program overhead in both cases.  Input loop is slower to paste into an emulator (especially at speed=1) due to the overheads of running a BASIC input/eval loop: if we're way too big then you'll need to chunk it anyway (try 150 lines at a time) so might as well use EQUD in this case. Also, don't use this if data is so big as to leave no room for A$ (although if that's the case then we might have bigger problems re c% + stack); above limits allow for this in default screen modes (6 on Electron and 7 on BBC)
-      bbc_micro[0]=bbc_micro[0].replace("NEW","NEW\n0LOMEM=TOP+"+str(len(bbc_micro)-1))
-      if use_input_loop: bbc_micro.insert(1,"P%=TOP:LOMEM=P%+"+str(len(bbc_micro)-1)) # need to set now for A$
-      else: bbc_micro.insert(1,"P%=TOP")
-      bbc_offset = 0 ; i = 2
-      if use_input_loop:
-        bbc_micro.insert(i,'REP.I.A$:IF LEN(A$):F.A%=1TO193STEP8:!P%=EVAL("&"+MID$(A$,A%,8)):P%=P%+4:N.:U.RIGHT$(A$,1)="*":EL.:U.0') ; i += 1 # horrible mix of if/else and repeat/until on 1 line in immediate mode so it copes with any extra blank lines that buggy emulators might insert
-        while i < len(bbc_micro)-100:
-          buf = []
-          for j in range(i,i+100): buf.append("%02X" % bbc_micro[j])
-          for j in range(0,100,4): buf[j],buf[j+1],buf[j+2],buf[j+3] = buf[j+3],buf[j+2],buf[j+1],buf[j] # LSB-MSB
-          del bbc_micro[i+1:i+100]
-          bbc_micro[i] = "".join(buf) ; i += 1
-        bbc_micro[i-1] += '*'
-      # Make up the rest (or if not use_input_loop) :
-      # TODO: Bas128 gives a "Wrap" error if P% crosses a 16k boundary (even if it's only doing EQUB), so may want a "use plain old indirection" option (low priority because Bas128 has timing issues anyway)
-      while i<len(bbc_micro):
-       buf = ["[OPT2"]
-       while i<len(bbc_micro) and len(buf)<16:
-        for fmt,nBytes in [("EQUD&%X",4),("EQUW%d",2),("EQUB%d",1)]:
-          if i+nBytes <= len(bbc_micro):
-            if nBytes==2 and i+3==len(bbc_micro) and bbc_micro[-1]==0: continue # in this case it might save a couple of keystrokes to end with EQUB *then* EQUW (if bbc_micro[i] is small; worst-case 255,255,0 is the same either way and the BRK optimisation could save 2 keystrokes if doing the EQUB second)
-            val = 0
-            for j in range(nBytes):
-              val += (bbc_micro[i+j]<<(j*8))
-            if nBytes==1: buf.append({0:"BRK",10:"ASLA",0x18:"CLC",0x38:"SEC",0x58:"CLI",0x78:"SEI",0xb8:"CLV",0xD8:"CLD",0xF8:"SED",0x4A:"LSRA",0xEA:"NOP",0x40:"RTI",0x60:"RTS"}.get(val,fmt%val)) # occasionally save a couple of keystrokes over the EQUB (usually with a BRK at end)
-            else: buf.append(fmt % val)
-            del bbc_micro[i:i+nBytes]
-            bbc_offset += nBytes
-            break
-       bbc_micro.insert(i,":".join(buf)+']') ; i += 1
-      # TODO: other methods to reduce keystrokes?  (Another thing that could be done is to automatically detect repeats in the MIDI file and get the BBC to do its own repeating instead of writing the data out twice, but this is likely to work only on automatically-generated MIDI files with strict quantised rhythm, otherwise it's likely to be subtly different on the repeat.)
-      if not use_input_loop: bbc_micro.append("LOMEM=P%") # because we didn't set it before (and might want to change MODE or something before running; anyway having it here makes it clearer what's going on if you see the screen at the end of the paste)
-    elif len(bbc_micro)>1 and len(bbc_micro[-1])<233: bbc_micro[-1] += ",255,0"
-    else: bbc_micro.append("D.255,0")
-    if not bbc_binary:
-      bbc_micro = "\n".join(bbc_micro).split("\n")
-      if bbc_sdl:
-        # bbc_sdl doesn't recognise keyword abbreviations, so use longhand:
-        bbc_micro = "\n".join(bbc_micro).replace("D.","DATA").replace("N.","NEXT").replace("U.","UNTIL").replace("SO.","SOUND").replace("REP.","REPEAT").replace("ENV.","ENVELOPE")
-        # Work around bbc_sdl bug #3 (on 1.12 and below) in the case of 2 notes per channel, by using a 0-length 3rd step that negates the 2nd step's change, which should clear up any piece with 6 notes or fewer per chord:
-        bbc_micro = bbc_micro.replace("V%=1","V%=1:Q%=0:R%=0")
-        if acorn_electron: bbc_micro=bbc_micro.replace("Q%=c%(1)-P%","Q%=c%(1)-P%:R%=-Q%")
-        else: bbc_micro=bbc_micro.replace("V%=2","V%=2:R%=-Q%")
-        # Add 1 octave if BBC BASIC for SDL (or BBC BASIC for Windows) is detected, because it's pitched an octave lower than the real BBC (well, we could use *VOICE c,5 to emphasize the first harmonic, but we'd have to check which versions support it and it's not quite the same) :
-        bbc_micro=bbc_micro.replace("N%=0","A%=-48*((INKEY(-256)AND219)=83):N%=0")
-        if acorn_electron: bbc_micro=bbc_micro.replace("P%,","P%+A%,")
-        else: bbc_micro=bbc_micro.replace("c%(I%),","c%(I%)+A%,")
-        # add line numbers, in case we're on a real BBC (as we can't use AUTO, which cannot be conditioned on INKEY(-256)); already added line numbers to DATA lines (so we know max length on real BBC) but others need adding:
-        bbc_micro = bbc_micro.split("\n")
-        for i in xrange(len(bbc_micro)):
-          bbc_micro[i]=str(i+1)+bbc_micro[i]
-      # If not bbc_sdl (and not bbc_binary), use AUTO.
-      # AUTO automatically stops once the line number would be >= 32768.  We can use this to avoid having to put an Escape into the keyboard buffer.
-      # TODO: If user is pasting this in multiple chunks, and emulator adds a spurious newline at the beginning of each chunk (e.g. BeebEm 3 on Mac), AUTO start number needs decreasing (unless user makes sure not to include the newline at the end of each chunk if the emulator will add its own at the start of the next)
-      elif len(bbc_micro) > 3277: bbc_micro.insert(0,"AU."+str(32768-len(bbc_micro))+",1") # (although if this is the case, program is extremely likely to exhaust the memory even in Bas128)
-      else: bbc_micro.insert(0,"AU."+str(32770-10*len(bbc_micro)))
-    print ("\n".join(bbc_micro))
+        if beep_direct: runBeep(cumulative_params)
+        else: runBeep(" ".join(cumulative_params))
+    if profile: profiler.end()
+def outputSize(): # for --profile: (amount of output so far, unit)
+  if aplay: return int(scheduler.scheduled*rate/1000.0+0.5),"samples"
+  elif bbc_micro or bbc_micro==[]:
+    if bbc_binary: return len(bbc_micro),"bytes"
+    else: return sum(len(l) for l in bbc_micro[1:]),"keystrokes" # of DATA
+  elif qbasic: return sum(len(l) for l in basData),"bytes"
+  elif mac_voice: return sum(len(p) for p in pcmData)//2,"samples"
+  elif riscos_Maestro or grub or voice_json: return 0,""
+  elif beep_direct: return len(cumulative_params),"tones"
+  else: return sum(len(p) for p in cumulative_params),"characters of beep parameters"
+
+# Charges the time between stage boundaries to whichever
+# stage we're in (so a stage's time excludes the stages it
+# calls), by wrapping the functions at the boundaries.
+# Nothing is wrapped unless --profile is given.
+timer = getattr(time,"perf_counter",monotonic)
+class Profiler:
+  def begin(self,midiFile):
+    self.file,self.seconds,self.stack = midiFile,{},["other"]
+    self.counts = {"events":0,"chords_in":0,"chords_out":0,"quantise_error_us":0}
+    self.output0 = 0 ; self.t = self.t0 = timer()
+  def enter(self,stage):
+    t = timer() ; s = self.stack[-1]
+    self.seconds[s] = self.seconds.get(s,0) + t-self.t
+    self.t = t ; self.stack.append(stage)
+  def leave(self):
+    t = timer() ; s = self.stack.pop()
+    self.seconds[s] = self.seconds.get(s,0) + t-self.t
+    self.t = t
+  def wrap(self,stage,f,count=None):
+    def g(*args):
+      if count: self.counts[count] += 1
+      self.enter(stage)
+      try: return f(*args)
+      finally: self.leave()
+    g.profiled = True ; return g
+  def parsed(self): # the rest is writing the output
+    self.enter("write") ; self.stack = ["write"]
+    self.output = outputSize()
+  def end(self):
+    self.leave() ; total = self.t-self.t0
+    out,unit = getattr(self,"output",None) or outputSize()
+    out -= self.output0 ; self.output = None
+    c = self.counts
+    if profile=="json": sys.stderr.write(json.dumps({"profile":self.file,"total_seconds":total,"seconds":self.seconds,"counts":c,"output":out,"output_unit":unit})+"\n") ; return
+    sys.stderr.write("Profile of %s: %.3fs\n" % (self.file,total))
+    for stage in ["parse","timeline","dedup","output","write","other"]:
+      if stage in self.seconds: sys.stderr.write("  %-8s %8.3fs %5.1f%%\n" % (stage,self.seconds[stage],100.0*self.seconds[stage]/(total or 1)))
+    sys.stderr.write("  %d events, %d chords in, %d out (%d merged)" % (c["events"],c["chords_in"],c["chords_out"],c["chords_in"]-c["chords_out"]))
+    if c["quantise_error_us"]: sys.stderr.write(", quantisation moved chords by %.3fs in total" % (c["quantise_error_us"]/1000000.0))
+    if unit: sys.stderr.write(", %d %s" % (out,unit))
+    sys.stderr.write("\n")
+
+profiler = Profiler()
+
+def setupProfile(): # (again after each setup(), which redefines the output functions)
+  global json,add_midi_note_chord,dedup_midi_note_chord,dedup_timeline,bbcFlush,init
+  if profile=="json": import json
+  if not hasattr(MidiToBeep.eof,"profiled"):
+    MidiFileParser.parseMTrkChunk = profiler.wrap("parse",MidiFileParser.parseMTrkChunk)
+    MidiToBeep.update_time = profiler.wrap("timeline",MidiToBeep.update_time,"events")
+    MidiToBeep.eof = profiler.wrap("timeline",MidiToBeep.eof)
+    dedup_timeline = profiler.wrap("dedup",dedup_timeline) # (with format 1's merging of the tracks, which it drives)
+    real_dedup = dedup_midi_note_chord
+    def dedup_midi_note_chord(noteNos,microsecs):
+      if microsecs==None: return real_dedup(noteNos,microsecs) # (flush)
+      profiler.counts["chords_in"] += 1
+      profiler.enter("dedup")
+      try: real_dedup(noteNos,microsecs)
+      finally: profiler.leave()
+      if dedup_microsec_quantise: profiler.counts["quantise_error_us"] += abs(dedup_microsec_error)
+  if hasattr(init,"profiled"): return
+  add_midi_note_chord = profiler.wrap("output",add_midi_note_chord,"chords_out")
+  if bbc_micro or bbc_micro==[]: bbcFlush = profiler.wrap("output",bbcFlush) # (the BBC's second pass)
+  real_init = init
+  def init():
+    real_init() ; profiler.output0 = outputSize()[0]
+  init.profiled = True
+
+def main():
+  global jobs
+  readOptions()
+  if delArg('--version'): print(__doc__),sys.exit(0)
+  if serve: return runServer()
+  if len(sys.argv)<2: sys.stderr.write(helpText),sys.exit(1)
+  elif delArg('--help'): print(helpText),sys.exit(0)
+  setup()
+  if acorn_electron: name = "MIDI to Acorn Electron"
+  elif (bbc_micro or bbc_micro==[]): name = "MIDI to BBC Micro"
+  elif riscos_Maestro: name = "MIDI to Maestro"
+  else: name = "MIDI Beeper"
+  sys.stderr.write(name+__doc__[__doc__.index(" v"):])
+  midiFiles = sys.argv[1:]
+  if jobs > 1 and len(midiFiles) > 1:
+    # Only for outputs that are independent per file (other
+    # modes play in real time or carry state across files);
+    # needs fork so workers start with our options and setup.
+    if not (bbc_ssd or riscos_Maestro or qbasic or mac_voice):
+      sys.stderr.write("--jobs ignored: this output can't be parallelised\n") ; jobs = 1
+    elif not hasattr(os,'fork'):
+      sys.stderr.write("--jobs ignored: needs fork()\n") ; jobs = 1
+  if jobs > 1 and len(midiFiles) > 1:
+    import multiprocessing
+    try: multiprocessing = multiprocessing.get_context("fork")
+    except AttributeError: pass # Python 2 always forks on Unix
+    pool = multiprocessing.Pool(min(jobs,len(midiFiles)))
+    results = pool.imap(convert,midiFiles,1) # (in order)
+  else: results = (convert(f) for f in midiFiles)
+  for midiFile in midiFiles: converted(midiFile,next(results))
+  finish()
+
+def converted(midiFile,bbcResult): # what main() does with convert()'s result
+  if bbc_ssd:
+    bbcFile = midiFile.replace(os.extsep+"midi","").replace(os.extsep+"mid","")
+    if os.sep in bbcFile: bbcFile=bbcFile[bbcFile.rindex(os.sep)+1:]
+    if not 0<len(bbcFile)<=7: bbcFile="TUNE%d" % (1+len(bbc_files))
+    bbc_files.append((bbcFile,)+bbcResult)
+
+def finish():
+  global bbc_micro
+  if aplay: aplay_finish()
+  if show_drift and scheduler.chords: scheduler.report()
+  if bbc_ssd and bbc_files:
+    sides = bbcPackDisks(bbc_files)
+    if bbc_dsd: disks = [(sides[i],(sides[i+1:] or [[]])[0]) for i in range(0,len(sides),2)]
+    else: disks = [(s,) for s in sides]
+    for i in range(len(disks)):
+      ssdFile = os.environ.get("DFS_TITLE","tunes")
+      if len(disks) > 1: ssdFile += str(i+1)
+      ssdFile += (".ssd",".dsd")[bbc_dsd]
+      sys.stderr.write("Writing output to %s\n" % ssdFile)
+      open(ssdFile,"wb").write((make_bbcMicro_DFS_image,make_bbcMicro_DSD_image)[bbc_dsd](*disks[i]))
+  elif bbc_micro:
+      if bbc_binary: # need to get it in via indirection
+        bbc_micro[1:] = bbcRepeats(bbc_micro[1:])
+        bbc_micro += [255,0]
+        data = bbc_micro[1:]
+        bbc_micro[0]=bbc_micro[0].replace("NEW","NEW\n0LOMEM=TOP+"+str(len(data)))
+        # TODO: Bas128 gives a "Wrap" error if P% crosses a 16k boundary (even if it's only doing EQUB), so may want a "use plain old indirection" option (low priority because Bas128 has timing issues anyway)
+        strategies = [("EQU",["P%=TOP"]+bbcEquLines(data)+["LOMEM=P%"])] # (LOMEM not set before, as might want to change MODE or something before running; anyway having it here makes it clearer what's going on if you see the screen at the end of the paste)
+        if len(data) < 15000: strategies.append(("input loop",["P%=TOP:LOMEM=P%+"+str(len(data))]+bbcInputLoopLines(data))) # (need to set LOMEM now for A$; and don't use this if data is so big as to leave no room for A$, although if that's the case then we might have bigger problems re c% + stack; this limit allows for it in default screen modes, 6 on Electron and 7 on BBC)
+        keys = [sum(len(l)+1 for l in [bbc_micro[0]]+lines) for _,lines in strategies]
+        for (name,_),k in zip(strategies,keys): sys.stderr.write("%s: %d keystrokes, about %d:%02d to paste at %d a second\n" % (name,k,k//bbc_paste_rate//60,k//bbc_paste_rate%60,bbc_paste_rate))
+        use_input_loop = keys[-1] <= bbc_paste_limit < keys[0] # saves keystrokes, but might not save actual typing time in a museum etc because EQUD can be copied and the EQU version is more 'chunked' and easier to track; Input loop is also slower to paste into an emulator (especially at speed=1) due to the overheads of running a BASIC input/eval loop, so use it only to get under the paste limit: if we're way too big then you'll need to chunk it anyway (try 150 lines at a time) so might as well use EQU in this case
+        bbc_micro = [bbc_micro[0]]+strategies[use_input_loop][1]
+        # TODO: other methods to reduce keystrokes?  (Repeats are already back-referenced by bbcRepeats, but that finds only exact ones, which are likely only in automatically-generated MIDI files with strict quantised rhythm; otherwise it's likely to be subtly different on the repeat.)
+        if keys[use_input_loop] > bbc_paste_limit: sys.stderr.write("This exceeds BeebEm's %d keystroke limit. Try pasting 150 lines at a time.\n" % bbc_paste_limit)
+      elif len(bbc_micro)>1 and len(bbc_micro[-1])<233: bbc_micro[-1] += ",255,0"
+      else: bbc_micro.append("D.255,0")
+      if not bbc_binary:
+        bbc_micro = "\n".join(bbc_micro).split("\n")
+        if bbc_sdl:
+          # bbc_sdl doesn't recognise keyword abbreviations, so use longhand:
+          bbc_micro = "\n".join(bbc_micro).replace("D.","DATA").replace("N.","NEXT").replace("U.","UNTIL").replace("SO.","SOUND").replace("REP.","REPEAT").replace("ENV.","ENVELOPE")
+          # Work around bbc_sdl bug #3 (on 1.12 and below) in the case of 2 notes per channel, by using a 0-length 3rd step that negates the 2nd step's change, which should clear up any piece with 6 notes or fewer per chord:
+          bbc_micro = bbc_micro.replace("V%=1","V%=1:Q%=0:R%=0")
+          if acorn_electron: bbc_micro=bbc_micro.replace("Q%=c%(1)-P%","Q%=c%(1)-P%:R%=-Q%")
+          else: bbc_micro=bbc_micro.replace("V%=2","V%=2:R%=-Q%")
+          # Add 1 octave if BBC BASIC for SDL (or BBC BASIC for Windows) is detected, because it's pitched an octave lower than the real BBC (well, we could use *VOICE c,5 to emphasize the first harmonic, but we'd have to check which versions support it and it's not quite the same) :
+          bbc_micro=bbc_micro.replace("N%=0","A%=-48*((INKEY(-256)AND219)=83):N%=0")
+          if acorn_electron: bbc_micro=bbc_micro.replace("P%,","P%+A%,")
+          else: bbc_micro=bbc_micro.replace("c%(I%),","c%(I%)+A%,")
+          # add line numbers, in case we're on a real BBC (as we can't use AUTO, which cannot be conditioned on INKEY(-256)); already added line numbers to DATA lines (so we know max length on real BBC) but others need adding:
+          bbc_micro = bbc_micro.split("\n")
+          for i in xrange(len(bbc_micro)):
+            bbc_micro[i]=str(i+1)+bbc_micro[i]
+        # If not bbc_sdl (and not bbc_binary), use AUTO.
+        # AUTO automatically stops once the line number would be >= 32768.  We can use this to avoid having to put an Escape into the keyboard buffer.
+        # TODO: If user is pasting this in multiple chunks, and emulator adds a spurious newline at the beginning of each chunk (e.g. BeebEm 3 on Mac), AUTO start number needs decreasing (unless user makes sure not to include the newline at the end of each chunk if the emulator will add its own at the start of the next)
+        elif len(bbc_micro) > 3277: bbc_micro.insert(0,"AU."+str(32768-len(bbc_micro))+",1") # (although if this is the case, program is extremely likely to exhaust the memory even in Bas128)
+        else: bbc_micro.insert(0,"AU."+str(32770-10*len(bbc_micro)))
+      print ("\n".join(bbc_micro))
+
+# --serve: the server's threads queue each request for one
+# of the worker processes (forked before any threads are
+# started), and each worker forks again to run the request
+# with the options as they were at startup, in a temporary
+# directory with standard output and error going to files
+# there.  So requests can't affect each other, and nothing
+# needs resetting between them.
+
+# Requests can set only these (as nothing else is checked
+# before it reaches a filename or a shell command):
+serve_env = ["DFS_TITLE","maxTime"]
+serve_options = ["--bbc","--electron","--bbc-binary","--bbc-ssd","--bbc-dsd","--bbc-sdl","--bbc-fixed-channels","--bbc-move-arpeggios","--maestro","--grub","--qbasic"]
+serve_valued = ["--bbc-noise-bass","--maestro-bpm","--maestro-tolerance"] # (options taking a value)
+
+def serveTask(args,env,midiData): # in the forked process
+  global grub_tune_file
+  prev = ""
+  for a in args:
+    if a.startswith("-"): ok = a in serve_options or a.split("=")[0] in serve_valued
+    else: ok = prev in serve_valued
+    if not ok: return 400,"text/plain","Not available with --serve: "+a+"\n"
+    prev = a
+  if not re.match("[A-Za-z0-9]{0,7}$",env.get("DFS_TITLE","")): return 400,"text/plain","DFS_TITLE must be up to 7 letters or digits\n"
+  open("tune.mid","wb").write(midiData)
+  os.environ.update(env)
+  sys.argv = [sys.argv[0]]+args+["tune.mid"]
+  sys.stdout = open("stdout","w") ; sys.stderr = open("stderr","w")
+  readOptions()
+  if not sys.argv[1:]==["tune.mid"]: return 400,"text/plain","Unrecognised: "+" ".join(sys.argv[1:-1])+"\n"
+  if mac_voice or mac_voice_praat_correction or voice_json: return 400,"text/plain","--serve can't run --Organ, --Joelle, --praat or --json\n"
+  if not (riscos_Maestro or bbc_micro or acorn_electron or qbasic or grub): return 400,"text/plain","--serve can't play sound: choose an output that makes a file\n"
+  if grub: grub_tune_file = os.environ["GRUB_TUNE"] = "tune" # never install it
+  setup()
+  converted("tune.mid",convert("tune.mid"))
+  finish() ; sys.stdout.close()
+  out = open("stdout","rb").read()
+  if out: return 200,"text/plain",out
+  files = [f for f in os.listdir(".") if not f in ["tune.mid","stdout","stderr"]]
+  if not len(files)==1: return 500,"text/plain","Expected one output file, got %d\n" % len(files)
+  return 200,"application/octet-stream",open(files[0],"rb").read()
+
+def serveWorker(conn):
+  import shutil,tempfile,traceback
+  while True:
+    try: task = conn.recv()
+    except (EOFError,KeyboardInterrupt): break
+    d = tempfile.mkdtemp(prefix="midi-beeper-")
+    pid = os.fork()
+    if not pid:
+      try:
+        os.chdir(d) ; r = serveTask(*task)
+      except:
+        sys.stderr.flush()
+        try: log = open(os.path.join(d,"stderr")).read()
+        except: log = ""
+        r = 500,"text/plain",log+"".join(traceback.format_exception_only(*sys.exc_info()[:2]))
+      try: conn.send(r)
+      except: os._exit(1)
+      os._exit(0)
+    if os.waitpid(pid,0)[1]: conn.send((500,"text/plain","Conversion process failed\n"))
+    shutil.rmtree(d,True)
+
+def runServer():
+  import json,threading,multiprocessing
+  try: import queue
+  except ImportError: import Queue as queue # Python 2
+  try:
+    from http.server import BaseHTTPRequestHandler,HTTPServer
+    import socketserver
+    from urllib.parse import unquote
+  except ImportError: # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+    import SocketServer as socketserver
+    from urllib import unquote
+  try: multiprocessing = multiprocessing.get_context("fork")
+  except AttributeError: pass # Python 2 always forks on Unix
+  nWorkers = jobs
+  if nWorkers < 2: nWorkers = multiprocessing.cpu_count()
+  tasks = queue.Queue() ; lock = threading.Lock()
+  stats = {"requests":0,"failed":0,"busy":0,"latency":[],"waits":[]}
+  started = time.time()
+  def startWorker():
+    conn,workerConn = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=serveWorker,args=(workerConn,))
+    p.daemon = True ; p.start() ; return conn
+  def dispatch(conn): # one thread per worker
+    while True:
+      task = tasks.get() ; t = time.time()
+      lock.acquire() ; stats["busy"] += 1 ; lock.release()
+      try:
+        conn.send(task["args"]) ; task["result"] = conn.recv()
+      except (EOFError,IOError,OSError):
+        task["result"] = 500,"text/plain","Worker failed\n"
+        conn = startWorker()
+      lock.acquire()
+      stats["busy"] -= 1 ; stats["requests"] += 1
+      if not task["result"][0]==200: stats["failed"] += 1
+      for k,v in [("waits",t-task["t"]),("latency",time.time()-task["t"])]:
+        stats[k].append(v) ; del stats[k][:-1000] # (only the last 1000)
+      lock.release()
+      task["done"].set()
+  def summary(times):
+    if not times: return {}
+    times = sorted(times)
+    return {"mean":sum(times)/len(times),"p50":times[len(times)//2],"p95":times[int(len(times)*0.95)],"max":times[-1]}
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # (keep-alive)
+    disable_nagle_algorithm = serve.isdigit() # (TCP only; otherwise keep-alive waits for ACKs)
+    def reply(self,status,contentType,data):
+      if not type(data)==type(b""): data = data.encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type",contentType)
+      self.send_header("Content-Length",str(len(data)))
+      self.end_headers() ; self.wfile.write(data)
+    def do_GET(self):
+      if not self.path=="/metrics": return self.reply(404,"text/plain","Not found\n")
+      lock.acquire()
+      m = {"workers":nWorkers,"busy":stats["busy"],"queued":tasks.qsize(),"requests":stats["requests"],"failed":stats["failed"],"uptime_seconds":time.time()-started,"latency_seconds":summary(stats["latency"]),"queue_wait_seconds":summary(stats["waits"])}
+      lock.release()
+      self.reply(200,"application/json",json.dumps(m)+"\n")
+    def do_POST(self):
+      path,query = (self.path+"?").split("?")[:2]
+      midiData = self.rfile.read(int(self.headers.get("Content-Length",0)))
+      if not path=="/convert": return self.reply(404,"text/plain","Not found\n")
+      args,env = [],{}
+      for a in query.split("&"):
+        a = unquote(a)
+        if a.split("=")[0] in serve_env: env[a.split("=")[0]] = a[a.index("=")+1:]
+        elif a: args.append(a)
+      task = {"args":(args,env,midiData),"t":time.time(),"done":threading.Event()}
+      tasks.put(task) ; task["done"].wait()
+      self.reply(*task["result"])
+    def log_message(self,format,*args): pass
+  conns = [startWorker() for _ in range(nWorkers)] # (before any threads)
+  for conn in conns:
+    t = threading.Thread(target=dispatch,args=(conn,))
+    t.daemon = True ; t.start()
+  if serve.isdigit():
+    class Server(socketserver.ThreadingMixIn,HTTPServer): daemon_threads = True
+    server = Server(("127.0.0.1",int(serve)),Handler)
+  else:
+    import stat
+    if os.path.exists(serve) and stat.S_ISSOCK(os.stat(serve).st_mode): os.remove(serve) # left from last time
+    class Server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer): daemon_threads = True
+    server = Server(serve,Handler)
+  sys.stderr.write("Serving on %s with %d workers\n" % (serve,nWorkers))
+  try: server.serve_forever()
+  except KeyboardInterrupt: pass
+
+if __name__=="__main__": main()
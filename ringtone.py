@@ -100,6 +100,9 @@ class MidiOutFile:
     def patch_change(self, channel, patch):
         slc = fromBytes([0xC0 + channel, patch])
         self.event_slice(slc)
+    def pitch_bend(self, channel, value=0x2000):
+        slc = fromBytes([0xE0 + channel, value & 0x7F, value >> 7])
+        self.event_slice(slc)
     def header(self, format=0, nTracks=1, division=96):
         raw = self.raw_out
         raw.writeSlice(B('MThd'))
@@ -129,30 +132,31 @@ class MidiOutFile:
             writeVar(len(data_slice)) +
             data_slice)
 
-mof = MidiOutFile('ringtone.mid')
-mof.header()
-mof.start_of_track()
-mof.patch_change(0,73) # flute
-mof.tempo(1000000)
-import random
-pitches = [0x40+random.randint(-10,20)]
-for i in range(random.randint(1,3)): pitches.append(pitches[-1]+random.randint(1,10))
-softPitches = [(c,pitches[c]) for c in range(len(pitches))]
-pitches *= 16 ; loudPitches = [(c,pitches[c]) for c in range(16) if not c==9] # duplicate on all channels except percussive-10 (9 when 0-based); helps some synths make it not too soft
-burstsPerRing = random.randint(7,14)
-totalCycleLen = 150
-half_burstTime = int(totalCycleLen*0.4/burstsPerRing/2)
-for velocity in [0x40,0x40,0x50,0x60,0,0x60,0x70,0x7f,0x7f,0,0x30,0x20,0x10,0x10,0]+[0x10,0x10,0x10,0x10,0]*10: # *4 is probably more than enough for the network to give up
-    for ring in [1,2]: # UK double-ring
-        for i in range(burstsPerRing):
-            if velocity > 0x40: pitches = loudPitches
-            elif velocity: pitches = softPitches
-            else: pitches = []
-            for c,p in pitches: mof.note_on(c,p,velocity),mof.reset_time()
-            mof.update_time(half_burstTime)
-            for c,p in pitches: mof.note_off(c,p,velocity),mof.reset_time()
-            mof.update_time(half_burstTime)
-        mof.update_time(totalCycleLen/10)
-    mof.update_time(totalCycleLen/2)
-mof.end_of_track() ; mof.write()
-print ("Generated a ringtone.mid (run again for another)")
+if __name__=="__main__":
+    mof = MidiOutFile('ringtone.mid')
+    mof.header()
+    mof.start_of_track()
+    mof.patch_change(0,73) # flute
+    mof.tempo(1000000)
+    import random
+    pitches = [0x40+random.randint(-10,20)]
+    for i in range(random.randint(1,3)): pitches.append(pitches[-1]+random.randint(1,10))
+    softPitches = [(c,pitches[c]) for c in range(len(pitches))]
+    pitches *= 16 ; loudPitches = [(c,pitches[c]) for c in range(16) if not c==9] # duplicate on all channels except percussive-10 (9 when 0-based); helps some synths make it not too soft
+    burstsPerRing = random.randint(7,14)
+    totalCycleLen = 150
+    half_burstTime = int(totalCycleLen*0.4/burstsPerRing/2)
+    for velocity in [0x40,0x40,0x50,0x60,0,0x60,0x70,0x7f,0x7f,0,0x30,0x20,0x10,0x10,0]+[0x10,0x10,0x10,0x10,0]*10: # *4 is probably more than enough for the network to give up
+        for ring in [1,2]: # UK double-ring
+            for i in range(burstsPerRing):
+                if velocity > 0x40: pitches = loudPitches
+                elif velocity: pitches = softPitches
+                else: pitches = []
+                for c,p in pitches: mof.note_on(c,p,velocity),mof.reset_time()
+                mof.update_time(half_burstTime)
+                for c,p in pitches: mof.note_off(c,p,velocity),mof.reset_time()
+                mof.update_time(half_burstTime)
+            mof.update_time(totalCycleLen/10)
+        mof.update_time(totalCycleLen/2)
+    mof.end_of_track() ; mof.write()
+    print ("Generated a ringtone.mid (run again for another)")